@@ -0,0 +1,253 @@
+"""
+Benchmarks of the conversion code (python benchmark.py)
+
+Prints the time and the peak memory (numpy allocations, traced by tracemalloc)
+of the conversion kernels on a synthetic grid of the size of HRRR.
+"""
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import convert
+
+#size of the HRRR CONUS grid
+benchmarkShape = (1059, 1799)
+benchmarkRepeat = 5
+
+def float_to_rgb_previous(arr, vmin, vmax):
+    """
+    float_to_rgb as it was before the integer rewrite (whole-array float64 temporaries),
+    kept as the reference for the comparisons. The bands were read with .astype(float).
+    """
+    arr = arr.astype(float)
+    int_max = 256 ** 3 - 1
+    normalized_value = np.round(((arr - vmin) / (vmax - vmin)) * int_max)
+    arr = np.clip(normalized_value, 0, int_max)
+    r = (arr // (256**2)) % 256
+    g = (arr // 256) % 256
+    b = arr % 256
+    return np.stack((r, g, b), axis=-1).astype(np.uint8)
+
+def measure(function, *args, repeat=benchmarkRepeat):
+    """
+    Time a function and trace the peak of the memory it allocates
+
+    Parameters:
+    function: function to call
+    *args: arguments of the function
+    repeat (int): number of calls, the best time is kept
+
+    Returns:
+    (float, int, result): best time in seconds, peak memory allocated in bytes, result of the last call
+    """
+    bestTime = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        if (bestTime == None or elapsed < bestTime):
+            bestTime = elapsed
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return bestTime, peak, result
+
+def printRow(name, elapsed, peak):
+    print(f"{name:<28}{elapsed*1000:>10.1f} ms{peak/1024/1024:>10.1f} MiB")
+
+def benchmarkFloatToRGB(shape=benchmarkShape, repeat=benchmarkRepeat):
+    """
+    Compare float_to_rgb with the previous implementation (speed, memory and output)
+
+    Parameters:
+    shape (tuple): shape of the synthetic band
+    repeat (int): number of timed calls
+
+    Returns:
+    bool: True if the outputs are bit-identical
+    """
+    rng = np.random.default_rng(0)
+    vmin, vmax = -80, 80
+    data = rng.uniform(vmin - 10, vmax + 10, shape)
+    #values on the rounding boundaries of the codes
+    data.flat[::7] = vmin + (vmax - vmin) * (rng.integers(0, 256**3, data.size)[::7] + 0.5) / (256**3 - 1)
+    dataFloat32 = data.astype(np.float32)
+    out = np.empty(shape + (3,), dtype=np.uint8)
+
+    print(f"float_to_rgb {shape[0]}x{shape[1]}")
+    identical = True
+    for name, arr in (("float64", data), ("float32", dataFloat32)):
+        previousTime, previousPeak, previous = measure(float_to_rgb_previous, arr, vmin, vmax, repeat=repeat)
+        newTime, newPeak, new = measure(convert.float_to_rgb, arr, vmin, vmax, None, repeat=repeat)
+        reuseTime, reusePeak, reuse = measure(convert.float_to_rgb, arr, vmin, vmax, out, repeat=repeat)
+        printRow(f"previous ({name})", previousTime, previousPeak)
+        printRow(f"new ({name})", newTime, newPeak)
+        printRow(f"new, reused out ({name})", reuseTime, reusePeak)
+        same = np.array_equal(previous, new) and np.array_equal(previous, reuse)
+        print(f"bit-identical: {same}")
+        identical = identical and same
+
+    nan = data.copy()
+    nan[:10] = np.nan
+    rgb = convert.float_to_rgb(nan, vmin, vmax, sentinel=0)
+    print(f"NaN mapped to sentinel: {bool((rgb[:10] == 0).all())}")
+    return identical
+
+def syntheticField(shape=benchmarkShape, vmin=-10, vmax=100):
+    """
+    Smooth synthetic field between vmin and vmax (like a reflectivity field), with a third of it at vmin
+    """
+    rows, cols = shape
+    y, x = np.mgrid[0:rows, 0:cols]
+    field = np.sin(x / 57.0) * np.cos(y / 43.0) + 0.5 * np.sin((x + y) / 19.0)
+    field = vmin + (field - field.min()) / (field.max() - field.min()) * (vmax - vmin)
+    field[field < vmin + (vmax - vmin) / 3] = vmin
+    return field.astype(np.float32)
+
+def benchmarkPrecision(shape=benchmarkShape, vmin=-10, vmax=100, modes=None, repeat=3):
+    """
+    Compare the size and the encoding time of a band with each precision of float_to_rgb
+
+    Parameters:
+    shape (tuple): shape of the synthetic band
+    vmin, vmax (float): range of the synthetic band
+    modes (list): (name, bits, step) to compare, by default 24-bit over vmin-vmax and 24, 16 and 8 bits
+                  with the finest step they allow
+    repeat (int): number of timed calls
+    """
+    if (modes == None):
+        modes = [("24-bit vmin-vmax", 24, None),
+                 ("24-bit step", 24, 0.00001),
+                 ("16-bit step", 16, 0.01),
+                 ("8-bit step", 8, 0.5)]
+    field = syntheticField(shape, vmin, vmax)
+
+    print(f"precision of a {shape[0]}x{shape[1]} band over {vmin} to {vmax}")
+    print(f"{'mode':<20}{'step':>12}{'float_to_rgb':>14}{'webp encode':>14}{'bytes':>12}{'max error':>12}")
+    for name, bits, step in modes:
+        rgbTime, _, rgb_array = measure(convert.float_to_rgb, field, vmin, vmax, None, 0, bits, step, repeat=repeat)
+        encodeTime, _, data = measure(convert.encodeWEBP, rgb_array, None, repeat=repeat)
+        #decode back to check the error stays within half a step
+        if (bits == 24):
+            codes = (rgb_array[..., 0].astype(np.int64) << 16) + (rgb_array[..., 1].astype(np.int64) << 8) + rgb_array[..., 2]
+        elif (bits == 16):
+            codes = (rgb_array[..., 0].astype(np.int64) << 8) + rgb_array[..., 1]
+        else:
+            codes = rgb_array[..., 0].astype(np.int64)
+        decodedStep = convert.precisionStep(vmin, vmax, bits, step)
+        maxError = np.abs(vmin + codes * decodedStep - field).max()
+        print(f"{name:<20}{decodedStep:>12.6g}{rgbTime*1000:>11.1f} ms{encodeTime*1000:>11.1f} ms{len(data):>12}{maxError:>12.6g}")
+
+def benchmarkDelta(shape=benchmarkShape, hours=12, bits=24, step=None):
+    """
+    Compare the size of a series of forecast hours encoded as keyframes and as deltas (deltaEncode)
+
+    Parameters:
+    shape (tuple): shape of the synthetic bands
+    hours (int): number of forecast hours, the synthetic field drifting a little each hour
+    bits (int): precision of float_to_rgb
+    step (float): step of float_to_rgb
+    """
+    rows, cols = shape
+    y, x = np.mgrid[0:rows, 0:cols]
+    convert.deltaHistory.clear()
+    keyframeBytes = 0
+    deltaBytes = 0
+    for hour in range(hours):
+        #temperature-like field moving slowly eastward and warming
+        field = (280 + 15 * np.sin((x + hour) / 150.0) * np.cos(y / 110.0) + 5 * np.sin((x - y) / 40.0) + 0.2 * hour).astype(np.float32)
+        rgb_array = convert.float_to_rgb(field, 200, 330, bits=bits, step=step)
+        keyframeBytes += len(convert.encodeWEBP(rgb_array, 0))
+        encoding = convert.deltaEncode(("benchmark",), hour * 3600, rgb_array, bits)
+        deltaBytes += len(convert.encodeWEBP(rgb_array, None if encoding["encoding"] == "delta" else 0, exact=True))
+    convert.deltaHistory.clear()
+
+    print(f"{hours} forecast hours {shape[0]}x{shape[1]}, {bits} bits, keyframe every {convert.delta_keyframe_interval} hours")
+    print(f"{'keyframes only':<28}{keyframeBytes:>12} bytes")
+    print(f"{'delta encoded':<28}{deltaBytes:>12} bytes{keyframeBytes / deltaBytes:>8.1f}x")
+
+def syntheticReprojection(shape, extent, width):
+    """
+    Save in the reprojection cache a synthetic map (random source pixels) for a fake grid
+
+    Returns:
+    tuple: (geotransform, projection) of the fake grid
+    """
+    geotransform = (0, 1, 0, 0, 0, -1)
+    projection = "benchmark"
+    outputWidth, outputHeight = convert.outputSize(extent, width)
+    key = convert.reprojectionKey(geotransform, projection, shape, extent, outputWidth, outputHeight)
+    os.makedirs(convert.reprojection_cache_dir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    np.save(os.path.join(convert.reprojection_cache_dir, key + ".npy"), rng.integers(-1, shape[0] * shape[1], (outputHeight, outputWidth), dtype=np.int32))
+    return geotransform, projection
+
+def benchmarkConversionWorkers(bands=16, shape=benchmarkShape, workers=None):
+    """
+    Compare the conversion of bands (float_to_rgb, reprojection and WebP encoding) in the
+    calling thread and in the process pool
+
+    Parameters:
+    bands (int): number of synthetic bands
+    shape (tuple): shape of the synthetic bands
+    workers (list): numbers of worker processes to try, by default 1, 2, 4, ... up to the number of cores
+    """
+    if (workers == None):
+        workers = [2 ** i for i in range(int(np.log2(os.cpu_count())) + 1)]
+    extent = [-134, 21, -60, 52]
+    #the synthetic map is kept out of the real reprojection cache
+    reprojectionCacheDir = convert.reprojection_cache_dir
+    conversionWorkers = convert.conversion_workers
+    convert.reprojection_cache_dir = tempfile.mkdtemp()
+    exportPath = tempfile.mkdtemp()
+    try:
+        convertBands(bands, shape, workers, extent, exportPath)
+    finally:
+        shutil.rmtree(convert.reprojection_cache_dir, ignore_errors=True)
+        convert.reprojection_cache_dir = reprojectionCacheDir
+        convert.reprojectionMaps.clear()
+        convert.conversion_workers = conversionWorkers
+        convert.conversionPool = None
+        shutil.rmtree(exportPath, ignore_errors=True)
+
+def convertBands(bands, shape, workers, extent, exportPath):
+    """
+    Timed conversions of benchmarkConversionWorkers
+    """
+    geotransform, projection = syntheticReprojection(shape, extent, None)
+    rng = np.random.default_rng(0)
+    data = [rng.uniform(-80, 80, shape) for i in range(bands)]
+
+    print(f"conversion of {bands} bands {shape[0]}x{shape[1]}")
+    start = time.perf_counter()
+    for i in range(bands):
+        rgb_array = convert.float_to_rgb(data[i], -80, 80)
+        convert.exportBands([os.path.join(exportPath, f"{i}.webp")], [rgb_array], geotransform, projection, extent, None, 0)
+    serialTime = time.perf_counter() - start
+    print(f"{'calling thread':<28}{serialTime:>10.2f} s")
+
+    for workerNb in workers:
+        convert.conversion_workers = workerNb
+        convert.conversionPool = None
+        pool = convert.getConversionPool()
+        #start the worker processes before timing
+        list(pool.map(abs, range(workerNb)))
+        start = time.perf_counter()
+        jobs = [convert.submitBand(data[i], -80, 80, os.path.join(exportPath, f"{i}.webp"), geotransform, projection, extent, None, 0) for i in range(bands)]
+        for future, sharedBlock in jobs:
+            future.result()
+            convert.releaseBand(sharedBlock)
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+        print(f"{str(workerNb) + ' worker processes':<28}{elapsed:>10.2f} s{serialTime / elapsed:>8.1f}x")
+
+if __name__ == "__main__":
+    benchmarkFloatToRGB()
+    benchmarkPrecision()
+    benchmarkDelta()
+    benchmarkDelta(bits=16, step=0.01)
+    benchmarkConversionWorkers()
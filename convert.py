@@ -1,13 +1,30 @@
 import re
+import sys
 import time
+import threading
+import hashlib
 from datetime import datetime, timezone
 import json
 import os
 import math
 import warnings
+import io
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
 import numpy as np
+import derived
+try:
+    import resource
+except ImportError:
+    #not available on Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
 import pyart
 import PIL
+import PIL.Image
 from osgeo import gdal, osr
 gdal.UseExceptions()
 from wand.image import Image
@@ -15,8 +32,45 @@ from wand.image import Image
 debug = True
 export_json = True
 file_width_resolution = 3000
+#rows normalized at a time by float_to_rgb (bounds the size of its float64 temporaries)
+float_to_rgb_block_rows = 128
 output_json_file = "model_extent.json"
 
+#bands are read as float32, grids larger than windowed_read_pixels are read windowed_read_rows rows at a time
+windowed_read_pixels = 4000000
+windowed_read_rows = 256
+#print the memory used by the process after each band
+report_memory = True
+
+#bands are remapped with precomputed reprojection index maps (one per model grid and output)
+#instead of calling gdal.Warp for every band
+use_reprojection_cache = True
+reprojection_cache_dir = "./reprojectioncache/"
+#all selected bands of a file are reprojected together in one pass instead of one warp per band
+batch_conversion = True
+
+#"webp": the reprojected arrays are encoded to lossless WebP in memory and written once
+#"png": PNG files written with GDAL, to be converted with convertToWEBP
+output_format = "webp"
+#lossless WebP encoder settings (method 0-6 and quality 0-100 trade encoding time for size),
+#can be given per variable to convertFromNCToPNG
+webp_method = 4
+webp_quality = 75
+#"frame": one image per band, "tiles": equirectangular tile pyramid of each band (see exportTiles), "both"
+output_layout = "frame"
+tile_size = 256
+#number of zoom levels of the pyramids, the most detailed one is the full frame
+tile_zoom_levels = 4
+#frames between two keyframes for the variables encoded as deltas (see deltaEncode)
+delta_keyframe_interval = 6
+#every frame (webp) of a variable is also appended to a pack of all the forecast hours of the run (see appendToPack)
+pack_time_series = False
+#number of worker processes converting the bands (float_to_rgb, reprojection, encoding)
+#band arrays are handed to them through shared memory, 0 converts in the calling thread
+conversion_workers = 0
+#settings given to the worker processes (they don't see changes made to the module after import)
+conversion_worker_settings = ["debug", "float_to_rgb_block_rows", "use_reprojection_cache", "reprojection_cache_dir", "webp_method", "webp_quality", "output_layout", "tile_size", "tile_zoom_levels", "report_memory"]
+
 def convertToWEBP(inputFile="input.png", exportFile="output.webp"):
     '''
     Converts an image file (e.g., PNG) to a WebP format using the Wand library.
@@ -47,10 +101,96 @@ def convertToWEBP(inputFile="input.png", exportFile="output.webp"):
         print(f"Finished converting PNG '{inputFile}' to webp '{exportFile}': {elapsed_time:.2f} seconds")
 
 
-def float_to_rgb(arr, vmin, vmax):
+def readBand(bandObj, out=None):
+    """
+    Read a raster band as float32 (GRIB2 values are unpacked as 32-bit floats, so nothing is lost)
+
+    Grids larger than windowed_read_pixels are read by windows of windowed_read_rows rows
+    straight into the output array.
+
+    Parameters:
+    bandObj (gdal.Band): band to read
+    out (np.ndarray): (optional) float32 array (rows, cols) reused between bands, replaced if its shape differs
+
+    Returns:
+    np.ndarray: float32 array of the band (out if it could be reused)
+    """
+    rows = bandObj.YSize
+    cols = bandObj.XSize
+    if (out is None or out.shape != (rows, cols) or out.dtype != np.float32):
+        out = np.empty((rows, cols), dtype=np.float32)
+
+    if (rows * cols <= windowed_read_pixels):
+        bandObj.ReadAsArray(buf_obj=out)
+    else:
+        for start in range(0, rows, windowed_read_rows):
+            windowRows = min(windowed_read_rows, rows - start)
+            bandObj.ReadAsArray(0, start, cols, windowRows, buf_obj=out[start:start + windowRows])
+    return out
+
+def memoryUsage():
+    """
+    Resident memory of the process and its peak, in bytes (None if it can't be measured)
+
+    Returns:
+    (int, int): current RSS and peak RSS
+    """
+    rss = None
+    peak = None
+    if (psutil != None):
+        info = psutil.Process().memory_info()
+        rss = info.rss
+        #peak working set on Windows
+        peak = getattr(info, "peak_wset", None)
+    elif (os.path.exists("/proc/self/statm")):
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    if (peak == None and resource != None):
+        #kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if (sys.platform != "darwin"):
+            peak *= 1024
+    return rss, peak
+
+def reportMemory(label, previousPeak=None):
+    """
+    Print the memory used by the process after a step (with report_memory)
+
+    Parameters:
+    label (str): name of the step
+    previousPeak (int): (optional) peak RSS before the step, to print how much the step raised it
+
+    Returns:
+    int: the peak RSS (to give back as previousPeak), None if unknown
+    """
+    if not (report_memory):
+        return previousPeak
+    rss, peak = memoryUsage()
+    message = f"memory after {label}:"
+    if (rss != None):
+        message += f" rss {rss / 1024**2:.0f} MiB"
+    if (peak != None):
+        message += f", peak {peak / 1024**2:.0f} MiB"
+        if (previousPeak != None):
+            message += f" (+{(peak - previousPeak) / 1024**2:.0f} MiB)"
+    print(message)
+    return peak
+
+def float_to_rgb(arr, vmin, vmax, out=None, sentinel=0, bits=24, step=None):
     """
     Convert a float array into a 24-bit RGB representation.
     Each float will be split into three 8-bit values for R, G, and B.
+
+    The values are normalized to [0, 16777215] block of rows by block of rows
+    (`float_to_rgb_block_rows`), in place in a small float64 buffer so the codes are
+    the same as a whole-array float64 normalization, then converted to uint32 codes
+    whose R, G and B bytes are extracted with shifts and masks straight into the
+    interleaved output buffer.
+
+    With a lower precision the codes are packed in fewer channels: 16 bits in R (high byte)
+    and G (low byte) with B at 0, 8 bits as grayscale (R = G = B), which compress much better.
+    With a step, the code of a value is round((value - vmin) / step) (decoded as vmin + code * step)
+    instead of the [vmin, vmax] range spread over all the codes.
     
     Parameters:
     arr : np.ndarray
@@ -59,60 +199,328 @@ def float_to_rgb(arr, vmin, vmax):
         The minimum float value for normalization.
     vmax : float
         The maximum float value for normalization.
+    out : np.ndarray (optional)
+        preallocated uint8 array of shape arr.shape + (3,) to write into (can be reused between bands)
+    sentinel : int
+        code given to NaN (nodata) values
+    bits : int
+        precision of the codes, 8, 16 or 24
+    step : float (optional)
+        value between two consecutive codes
     
     Returns:
     np.ndarray
-        An array representing the RGB image.
+        An array representing the RGB image (out if given).
     """
+    if not (bits in [8, 16, 24]):
+        raise Exception("precision not supported: " + str(bits) + " bits")
+    int_max = 2 ** bits - 1  # 16777215 (24-bit maximum)
+
+    if (out is None):
+        out = np.empty(arr.shape + (3,), dtype=np.uint8)
+    if (arr.size == 0):
+        return out
+
+    rows = arr.shape[0]
+    blockRows = min(rows, float_to_rgb_block_rows)
+    normalizedBuffer = np.empty((blockRows,) + arr.shape[1:], dtype=np.float64)
+    codesBuffer = np.empty(normalizedBuffer.shape, dtype=np.uint32)
+    shiftedBuffer = np.empty(normalizedBuffer.shape, dtype=np.uint32)
+
+    for start in range(0, rows, blockRows):
+        stop = min(start + blockRows, rows)
+        normalized = normalizedBuffer[:stop - start]
+        codes = codesBuffer[:stop - start]
+        shifted = shiftedBuffer[:stop - start]
+
+        # Linear transformation from [vmin, vmax] to [0, int_max] (or by steps from vmin)
+        normalized[...] = arr[start:stop]
+        np.subtract(normalized, vmin, out=normalized)
+        if (step == None):
+            np.divide(normalized, vmax - vmin, out=normalized)
+            np.multiply(normalized, int_max, out=normalized)
+        else:
+            np.divide(normalized, step, out=normalized)
+        np.round(normalized, out=normalized)
+        np.clip(normalized, 0, int_max, out=normalized)
+        np.copyto(normalized, sentinel, where=np.isnan(normalized))
+        np.copyto(codes, normalized, casting="unsafe")
+
+        block = out[start:stop]
+        if (bits == 24):
+            # Get R, G, B values with shifts and masks of the 24-bit codes
+            np.right_shift(codes, 16, out=shifted)
+            np.copyto(block[..., 0], shifted, casting="unsafe")
+            np.right_shift(codes, 8, out=shifted)
+            np.bitwise_and(shifted, 255, out=shifted)
+            np.copyto(block[..., 1], shifted, casting="unsafe")
+            np.bitwise_and(codes, 255, out=shifted)
+            np.copyto(block[..., 2], shifted, casting="unsafe")
+        elif (bits == 16):
+            np.right_shift(codes, 8, out=shifted)
+            np.copyto(block[..., 0], shifted, casting="unsafe")
+            np.bitwise_and(codes, 255, out=shifted)
+            np.copyto(block[..., 1], shifted, casting="unsafe")
+            block[..., 2] = 0
+        else:
+            for channel in range(3):
+                np.copyto(block[..., channel], codes, casting="unsafe")
 
-    # Step 1: Normalize float value to [0, 16777215]
-    old_min = vmin
-    old_max = vmax
-    int_max = 256 ** 3 - 1  # 16777215 (24-bit maximum)
-
-    # Linear transformation from [vmin, vmax] to [0, 16777215]
-    normalized_value = np.round(((arr - old_min) / (old_max - old_min)) * int_max)
+    return out
 
-    arr = np.clip(normalized_value, 0, int_max)
-    
-    # Get R, G, B values by base-256 representation
-    r = (arr // (256**2)) % 256
-    g = (arr // 256) % 256
-    b = arr % 256
-    
-    # Stack to create an RGB image
-    rgb = np.stack((r, g, b), axis=-1).astype(np.uint8)
-    
-    return rgb    
+def precisionStep(vmin, vmax, bits=24, step=None):
+    """
+    Value between two consecutive codes of float_to_rgb (to decode: vmin + code * step)
+    """
+    if (step != None):
+        return step
+    return (vmax - vmin) / (2 ** bits - 1)
 
 def saveToJSON(extent, output_file, model):
+    #called under extentLock, the file is replaced atomically so readers never see it half written
     # Check if the JSON file exists
-        if os.path.exists(output_file):
-            # Load the existing JSON data
-            with open(output_file, 'r') as f:
-                data = json.load(f)
-        else:
-            # If the file doesn't exist, create an empty dictionary
-            data = {}
-                
-        # Update or add the model_name key with the extent value
-        data[model] = [extent[0],extent[1],extent[2],extent[3]]
+    if os.path.exists(output_file):
+        # Load the existing JSON data
+        with open(output_file, 'r') as f:
+            data = json.load(f)
+    else:
+        # If the file doesn't exist, create an empty dictionary
+        data = {}
+            
+    # Update or add the model_name key with the extent value
+    data[model] = [extent[0],extent[1],extent[2],extent[3]]
 
-        # Save the updated data back to the JSON file
-        with open(output_file, 'w') as f:
-            json.dump(data, f, indent=4)
+    # Save the updated data back to the JSON file
+    saveBytes(output_file, json.dumps(data, indent=4).encode())
 
-            
+class RunManifest:
+    """
+    Manifest of a model run, replacing the JSON written next to every image
+
+    Holds the extent of the model and, for every forecast (by forecast seconds), the ref/valid
+    times and, for every variable.level, its file, vmin/vmax, precision and step. It is updated
+    in memory by the conversions (thread-safe) and written in one piece (temporary file renamed)
+    when flush is called, so the client gets a whole run with one request.
+    """
+    def __init__(self, filepath, model=None, run=None):
+        """
+        Parameters:
+        filepath (str): manifest file, the files are listed relative to its folder
+        model (str): model name
+        run (str): run (epoch of the run in run_model)
+        """
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.data = {"model": model, "run": run, "extent": None, "forecasts": {}}
+        self.changed = False
+
+        #continue the manifest of a run restarted
+        if os.path.exists(filepath):
+            try:
+                with open(filepath, "r") as f:
+                    saved = json.load(f)
+                if (saved.get("model") == model and saved.get("run") == run):
+                    self.data["extent"] = saved.get("extent")
+                    for forecast in saved.get("forecasts", []):
+                        self.data["forecasts"][str(forecast["forecastSeconds"])] = forecast
+            except Exception as e:
+                print(f"unreadable manifest {filepath}: {e}")
+
+    def setExtent(self, extent):
+        with self.lock:
+            if (self.data["extent"] != list(extent)):
+                self.data["extent"] = list(extent)
+                self.changed = True
+
+    def addBand(self, bandInfo, variable, level, file, **fields):
+        """
+        Record a converted band
+
+        Parameters:
+        bandInfo (dict): band of gribInventory (forecast seconds and ref/valid times)
+        variable, level (str): variable and level of the band
+        file (str): file written for the band
+        **fields: other fields of the band (vmin, vmax, precision, step...)
+        """
+        try:
+            relativeFile = os.path.relpath(file, os.path.dirname(self.filepath))
+        except ValueError:
+            #not on the same drive
+            relativeFile = file
+        entry = {"file": relativeFile.replace(os.sep, "/")}
+        entry.update(fields)
+
+        with self.lock:
+            forecast = self.data["forecasts"].setdefault(str(bandInfo["forecastSeconds"]), {
+                "forecastSeconds": bandInfo["forecastSeconds"],
+                "run": bandInfo["refTime"],
+                "forecastTime": bandInfo["validTime"],
+                "variables": {}
+            })
+            forecast["variables"][variable + "." + level] = entry
+            self.changed = True
+
+    def flush(self):
+        """
+        Write the manifest if it changed since the last flush
+
+        Returns:
+        bool: True if it was written
+        """
+        with self.lock:
+            if not (self.changed):
+                return False
+            data = dict(self.data)
+            data["forecasts"] = sorted(self.data["forecasts"].values(), key=lambda forecast: forecast["forecastSeconds"])
+            saveBytes(self.filepath, json.dumps(data).encode())
+            self.changed = False
+            return True
+
+#extents already computed, by (projection, geotransform, x size, y size)
+rasterExtents = {}
+extentLock = threading.Lock()
+
+def edgeCoordinates(geotransform, x_size, y_size):
+    """
+    Coordinates in the dataset's CRS of every pixel of the four edges of a raster
+
+    Parameters:
+    geotransform (tuple): GDAL geotransform of the raster
+    x_size, y_size (int): size of the raster
+
+    Returns:
+    (np.ndarray, np.ndarray): x and y coordinates
+    """
+    x = np.arange(x_size, dtype=np.float64)
+    y = np.arange(y_size, dtype=np.float64)
+    # top and bottom edges, then left and right edges
+    px = np.concatenate([x, x, np.zeros(y_size), np.full(y_size, x_size - 1.0)])
+    py = np.concatenate([np.zeros(x_size), np.full(x_size, y_size - 1.0), y, y])
+
+    x_geo = geotransform[0] + px * geotransform[1] + py * geotransform[2]
+    y_geo = geotransform[3] + px * geotransform[4] + py * geotransform[5]
+    return x_geo, y_geo
+
+def rotatedPoleParameters(projection):
+    """
+    Parameters of a rotated pole grid (GRIB convention, e.g. HRDPS) from the WKT given by GDAL
+
+    Parameters:
+    projection (str): WKT of the dataset
+
+    Returns:
+    tuple: (latitude, longitude of the southern pole, axis rotation angle) in degrees,
+           None if the projection isn't a pole rotation
+    """
+    if not ("Pole rotation" in projection):
+        return None
+    parameters = []
+    for name in ("Latitude of the southern pole", "Longitude of the southern pole", "Axis rotation angle"):
+        match = re.search(r'PARAMETER\["' + name + r'[^"]*",\s*([-+0-9.eE]+)', projection)
+        if (match == None):
+            if (name == "Axis rotation angle"):
+                parameters.append(0.0)
+                continue
+            raise Exception("rotated pole parameter not found: " + name)
+        parameters.append(float(match.group(1)))
+    return tuple(parameters)
+
+def rotatedToGeographic(rlon, rlat, southPoleLat, southPoleLon, angle=0.0):
+    """
+    Lon/lat of rotated pole coordinates (GRIB convention), on whole arrays
+
+    The rotated sphere is turned by angle around its polar axis, then its south pole is moved
+    to (southPoleLat, southPoleLon), the rotated meridian 0 being on the geographic meridian southPoleLon.
+
+    Parameters:
+    rlon, rlat (np.ndarray): rotated longitudes and latitudes in degrees
+    southPoleLat, southPoleLon, angle (float): from rotatedPoleParameters
+
+    Returns:
+    (np.ndarray, np.ndarray): longitudes (-180 to 180) and latitudes in degrees
+    """
+    rlon = np.radians(np.asarray(rlon, dtype=np.float64) + angle)
+    rlat = np.radians(np.asarray(rlat, dtype=np.float64))
+    theta = np.radians(90.0 + southPoleLat)
+    x = np.cos(rlat) * np.cos(rlon)
+    y = np.cos(rlat) * np.sin(rlon)
+    z = np.sin(rlat)
+    #rotation by theta around the y axis
+    xg = np.cos(theta) * x - np.sin(theta) * z
+    zg = np.sin(theta) * x + np.cos(theta) * z
+    lat = np.degrees(np.arcsin(np.clip(zg, -1.0, 1.0)))
+    lon = np.degrees(np.arctan2(y, xg)) + southPoleLon
+    return (lon + 180.0) % 360.0 - 180.0, lat
+
+def geographicToRotated(lon, lat, southPoleLat, southPoleLon, angle=0.0):
+    """
+    Rotated pole coordinates (GRIB convention) of lon/lat, on whole arrays (inverse of rotatedToGeographic)
+
+    Returns:
+    (np.ndarray, np.ndarray): rotated longitudes (-180 to 180) and latitudes in degrees
+    """
+    lon = np.radians(np.asarray(lon, dtype=np.float64) - southPoleLon)
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    theta = np.radians(90.0 + southPoleLat)
+    x = np.cos(lat) * np.cos(lon)
+    y = np.cos(lat) * np.sin(lon)
+    z = np.sin(lat)
+    xr = np.cos(theta) * x + np.sin(theta) * z
+    zr = -np.sin(theta) * x + np.cos(theta) * z
+    rlat = np.degrees(np.arcsin(np.clip(zr, -1.0, 1.0)))
+    rlon = np.degrees(np.arctan2(y, xr)) - angle
+    return (rlon + 180.0) % 360.0 - 180.0, rlat
+
+def computeRasterExtent(geotransform, projection, x_size, y_size):
+    """
+    Extent [lon_min, lat_min, lon_max, lat_max] of a raster from the lon/lat of all of its edge pixels
+
+    The whole edge is transformed at once, with rotatedToGeographic for rotated pole
+    grids and a single TransformPoints call for the other projections.
+    """
+    rotatedPole = rotatedPoleParameters(projection)
+    if (rotatedPole != None):
+        rlon, rlat = edgeCoordinates(geotransform, x_size, y_size)
+        lon, lat = rotatedToGeographic(rlon, rlat, *rotatedPole)
+        return [float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())]
+
+    # Define the source projection
+    source_proj = osr.SpatialReference()
+    source_proj.ImportFromWkt(projection)
+
+    if (source_proj.IsGeographic()):
+        # Return the extent using the geotransform if already in lat/lon (WGS84)
+        lon_min = geotransform[0]
+        lon_max = geotransform[0] + x_size * geotransform[1]
+        lat_max = geotransform[3]
+        lat_min = geotransform[3] + y_size * geotransform[5]
+        return [min(lon_min, lon_max), min(lat_min, lat_max), max(lon_min, lon_max), max(lat_min, lat_max)]
+
+    # Define the target projection (WGS84, lat/lon) with lon/lat axis order
+    target_proj = osr.SpatialReference()
+    target_proj.ImportFromEPSG(4326)  # EPSG code for WGS84
+    source_proj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    target_proj.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    # Create a coordinate transformation object
+    transform = osr.CoordinateTransformation(source_proj, target_proj)
+
+    x_geo, y_geo = edgeCoordinates(geotransform, x_size, y_size)
+    lonlat = np.array(transform.TransformPoints(np.column_stack((x_geo, y_geo)).tolist()))
+    lon = lonlat[:, 0]
+    lat = lonlat[:, 1]
+    return [float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())]
 
 def get_raster_extent_in_lonlat(dataset, model, output_file=output_json_file):
     """
     Get the extent of a raster in longitude and latitude (WGS84).
 
-    This function opens a raster file and iterates to find the true highest and lowest
-    lons and lats.
+    The lon/lat of every pixel of the raster edges are computed at once to find the
+    true highest and lowest lons and lats. The extent is memoized per projection,
+    geotransform and size so the other forecast hours of a model get it for free.
 
-    Save the raster extent to a JSON file. If the model key exists, update its value.
-    Otherwise, append the model key with the new value.
+    Save the raster extent to a JSON file when it is computed. If the model key exists,
+    update its value. Otherwise, append the model key with the new value.
 
     Parameters:
     - GDAL dataset: dataset of raster to analyze
@@ -133,129 +541,509 @@ def get_raster_extent_in_lonlat(dataset, model, output_file=output_json_file):
     # Get the raster's geotransform and projection
     geotransform = dataset.GetGeoTransform()
     projection = dataset.GetProjection()
-    
-    # Get dataset dimensions
     x_size = dataset.RasterXSize
     y_size = dataset.RasterYSize
 
-    # Extract extent in the original CRS (coordinate reference system)
-    x_min = geotransform[0]
-    y_max = geotransform[3]
-    x_max = x_min + geotransform[1] * x_size
-    y_min = y_max + geotransform[5] * y_size
-    
-    # Define the source projection
-    source_proj = osr.SpatialReference()
-    source_proj.ImportFromWkt(dataset.GetProjection())
+    key = (projection, tuple(geotransform), x_size, y_size)
+    with extentLock:
+        if key in rasterExtents:
+            return list(rasterExtents[key])
 
-    
+        extent = computeRasterExtent(geotransform, projection, x_size, y_size)
+        rasterExtents[key] = extent
+        print(extent)
+
+        #export file
+        if (output_file != None and export_json == True):
+            print("exported")
+            saveToJSON(extent, output_file, model)
+
+    # Return the extent in lon/lat
+    return list(extent)
+
+#reprojection maps already loaded, by key of reprojectionKey
+reprojectionMaps = {}
+reprojectionLock = threading.Lock()
+
+def reprojectionKey(geotransform, projection, shape, extent, width, height):
     """
+    Hash of a source grid and of an EPSG:4326 output (bounds and size), used to name its reprojection map
+    """
+    description = json.dumps([list(geotransform), projection, list(shape), list(extent), width, height])
+    return hashlib.sha1(description.encode()).hexdigest()[:24]
 
-    code not working yet
-
-    if ("Pole rotation" in projection):
-        sample_rate = 1
-        # Initialize min and max values
-        lat_min, lon_max = float('inf'), -float('inf')
-        lon_min, lat_max = float('inf'), -float('inf')
-        lonp = float(projection.split(",")[projection.split(",").index('PARAMETER["Longitude of the southern pole (GRIB convention)"')+1])+180
-        latp = -float(projection.split(",")[projection.split(",").index('PARAMETER["Latitude of the southern pole (GRIB convention)"')+1])
-        for x in range(0, x_size, sample_rate):
-            for y in [0, y_size - 1]:  # top and bottom edges
-                # Get pixel (x, y) coordinates in dataset's projection
-                lon_r = geotransform[0] + x * geotransform[1] + y * geotransform[2]
-                lat_r = geotransform[3] + x * geotransform[4] + y * geotransform[5]
-
-                # Transform the coordinates to lat/lon
-                lon, lat = convert_pole_rotation_to_normal(lat_r, lon_r, lonp, latp)
-
-                # Update min/max lat and lon
-                lat_min = min(lat_min, lat)
-                lat_max = max(lat_max, lat)
-                lon_min = min(lon_min, lon)
-                lon_max = max(lon_max, lon)
-
-        for y in range(0, y_size, sample_rate):
-            for x in [0, x_size - 1]:  # left and right edges
-                # Get pixel (x, y) coordinates in dataset's projection
-                lon_r = geotransform[0] + x * geotransform[1] + y * geotransform[2]
-                lat_r = geotransform[3] + x * geotransform[4] + y * geotransform[5]
-
-                # Transform the coordinates to lat/lon
-                lon, lat = convert_pole_rotation_to_normal(lat_r, lon_r, lonp, latp)
-
-                # Update min/max lat and lon
-                lat_min = min(lat_min, lat)
-                lat_max = max(lat_max, lat)
-                lon_min = min(lon_min, lon)
-                lon_max = max(lon_max, lon)
-    """
-    if (model=="HRDPS"):
-        lat_min, lon_min, lat_max, lon_max = -152.78, 27.22, -40.7, 70.6 
-
-    elif (source_proj.IsGeographic()):
-        # Return the extent using the geotransform if already in lat/lon (WGS84)
-        lon_max = geotransform[0]
-        lon_min = geotransform[0] + dataset.RasterXSize * geotransform[1]
-        lat_max = geotransform[3]
-        lat_min = geotransform[3] + dataset.RasterYSize * geotransform[5]
+def buildReprojectionMap(geotransform, projection, shape, extent, width, height):
+    """
+    Compute the source pixel of every output pixel of the EPSG:4326 warp
+
+    A raster of the source grid holding its own pixel indexes is warped once with the same
+    options as the bands (nearest neighbour), so the map selects exactly the pixels gdal.Warp would.
+
+    Parameters:
+    geotransform, projection: georeferencing of the source grid
+    shape (tuple): (rows, cols) of the source grid
+    extent (list): output bounds [xmin, ymin, xmax, ymax] in lon/lat
+    width, height (int): output size in pixels
+
+    Returns:
+    np.ndarray: int32 array (height, width) of flat source indexes, -1 outside the source grid
+    """
+    if (rotatedPoleParameters(projection) != None):
+        return buildRotatedReprojectionMap(geotransform, projection, shape, extent, width, height)
+
+    rows, cols = shape
+    driver = gdal.GetDriverByName('MEM')
+    indexDataset = driver.Create('', cols, rows, 1, gdal.GDT_Int32)
+    indexDataset.SetGeoTransform(geotransform)
+    indexDataset.SetProjection(projection)
+    indexDataset.GetRasterBand(1).WriteArray(np.arange(rows * cols, dtype=np.int32).reshape(rows, cols))
+
+    warped = gdal.Warp(
+        '',
+        indexDataset,
+        dstSRS="EPSG:4326",
+        outputBounds=extent,
+        width=width,
+        height=height,
+        outputType=gdal.GDT_Int32,
+        dstNodata=-1,
+        format="MEM"
+    )
+    indexMap = warped.GetRasterBand(1).ReadAsArray()
+    warped = None
+    indexDataset = None
+    return indexMap
+
+def buildRotatedReprojectionMap(geotransform, projection, shape, extent, width, height):
+    """
+    buildReprojectionMap of a rotated pole grid, computed with NumPy
+
+    The lon/lat of the center of every output pixel is rotated (geographicToRotated) and
+    turned into a source pixel with the inverse geotransform (nearest neighbour, as gdal.Warp).
+
+    Parameters and returns:
+    same as buildReprojectionMap
+    """
+    rows, cols = shape
+    southPoleLat, southPoleLon, angle = rotatedPoleParameters(projection)
+    lon = extent[0] + (np.arange(width) + 0.5) * (extent[2] - extent[0]) / width
+    lat = extent[3] - (np.arange(height) + 0.5) * (extent[3] - extent[1]) / height
+    lon, lat = np.meshgrid(lon, lat)
+    rlon, rlat = geographicToRotated(lon, lat, southPoleLat, southPoleLon, angle)
+    lon = lat = None
+
+    #rotated longitudes in the 360 degrees starting at the origin of the grid
+    x0, dx, rx, y0, ry, dy = geotransform
+    if (rx == 0 and dx > 0):
+        rlon = x0 + (rlon - x0) % 360.0
+    det = dx * dy - rx * ry
+    col = np.floor((dy * (rlon - x0) - rx * (rlat - y0)) / det)
+    row = np.floor((dx * (rlat - y0) - ry * (rlon - x0)) / det)
+    rlon = rlat = None
+
+    inside = (col >= 0) & (col < cols) & (row >= 0) & (row < rows)
+    indexMap = np.full((height, width), -1, dtype=np.int32)
+    indexMap[inside] = (row[inside] * cols + col[inside]).astype(np.int32)
+    return indexMap
+
+def getReprojectionMap(geotransform, projection, shape, extent, width, height):
+    """
+    Get the reprojection map of a source grid and output, computing it only once
+
+    Maps are saved in reprojection_cache_dir as .npy files named by their key and
+    memory-mapped when read back.
+
+    Parameters:
+    same as buildReprojectionMap
+
+    Returns:
+    tuple: (indexMap, uncovered) indexMap from buildReprojectionMap and a boolean mask of the
+           output pixels outside of the source grid
+    """
+    key = reprojectionKey(geotransform, projection, shape, extent, width, height)
+    with reprojectionLock:
+        if key in reprojectionMaps:
+            return reprojectionMaps[key]
+
+        filepath = os.path.join(reprojection_cache_dir, key + ".npy")
+        indexMap = None
+        if os.path.exists(filepath):
+            try:
+                indexMap = np.load(filepath, mmap_mode="r")
+                if (indexMap.shape != (height, width)):
+                    indexMap = None
+            except Exception as e:
+                print(f"unreadable reprojection map {filepath}: {e}")
+                indexMap = None
+
+        if (indexMap is None):
+            start_time = time.time()
+            os.makedirs(reprojection_cache_dir, exist_ok=True)
+            tempPath = filepath + ".part"
+            with open(tempPath, "wb") as f:
+                np.save(f, buildReprojectionMap(geotransform, projection, shape, extent, width, height))
+            os.replace(tempPath, filepath)
+            indexMap = np.load(filepath, mmap_mode="r")
+            print(f"computed reprojection map {key}: {time.time() - start_time:.2f} seconds")
+
+        reprojectionMaps[key] = (indexMap, indexMap < 0)
+        return reprojectionMaps[key]
+
+def remapArray(array, reprojectionMap, nodata, out=None):
+    """
+    Reproject an array (rows, cols, channels) of the source grid with a single gather
+
+    Parameters:
+    array (np.ndarray): source array, C-contiguous
+    reprojectionMap (tuple): from getReprojectionMap
+    nodata: value given to the output pixels outside of the source grid
+    out (np.ndarray): (optional) preallocated output
+
+    Returns:
+    np.ndarray: the reprojected array (height, width, channels)
+    """
+    indexMap, uncovered = reprojectionMap
+    flat = array.reshape((-1,) + array.shape[2:])
+    if (out is None):
+        out = np.empty(indexMap.shape + array.shape[2:], dtype=array.dtype)
+    #-1 (outside) wraps to the last pixel and is overwritten with nodata
+    np.take(flat, indexMap, axis=0, mode="wrap", out=out)
+    out[uncovered] = nodata
+    return out
+
+def encodeWEBP(rgb_array, nodata=None, method=None, quality=None, exact=False):
+    """
+    Encode an array to lossless WebP in memory
+
+    Parameters:
+    rgb_array (np.ndarray): (height, width, 3) uint8 array
+    nodata: (optional) pixels equal to nodata on all channels are made transparent
+            (as the tRNS of the PNG written by GDAL did)
+    method (int): WebP method 0 (fast) to 6 (smallest), webp_method if None
+    quality (int): lossless effort 0 to 100, webp_quality if None
+    exact (bool): keep the rgb of the transparent pixels (the encoder may change them otherwise)
+
+    Returns:
+    bytes: the WebP file
+    """
+    if (method == None):
+        method = webp_method
+    if (quality == None):
+        quality = webp_quality
+
+    if (nodata != None):
+        rgba = np.empty(rgb_array.shape[:2] + (4,), dtype=np.uint8)
+        rgba[:, :, :3] = rgb_array
+        transparent = (rgb_array[:, :, 0] == nodata) & (rgb_array[:, :, 1] == nodata) & (rgb_array[:, :, 2] == nodata)
+        rgba[:, :, 3] = np.where(transparent, 0, 255)
+        image = PIL.Image.fromarray(rgba)
     else:
-        # Define the target projection (WGS84, lat/lon)
-        target_proj = osr.SpatialReference()
-        target_proj.ImportFromEPSG(4326)  # EPSG code for WGS84
-
-        # Create a coordinate transformation object
-        transform = osr.CoordinateTransformation(source_proj, target_proj)
-
-        # Initialize min and max values
-        lat_min, lon_max = float('inf'), -float('inf')
-        lon_min, lat_max = float('inf'), -float('inf')
-
-        #To avoid processing every single pixel, sample along the edges of the image at a specified rate
-        #A lower sample_rate will make the result more accurate but slower.
-        sample_rate = 10
-
-        # Iterate over the dataset edges at the sample rate
-        for x in range(0, x_size, sample_rate):
-            for y in [0, y_size - 1]:  # top and bottom edges
-                # Get pixel (x, y) coordinates in dataset's projection
-                x_geo = geotransform[0] + x * geotransform[1]
-                y_geo = geotransform[3] + y * geotransform[5]
-
-                # Transform the coordinates to lat/lon
-                lon, lat, _ = transform.TransformPoint(x_geo, y_geo)
-
-                # Update min/max lat and lon
-                lat_min = min(lat_min, lat)
-                lat_max = max(lat_max, lat)
-                lon_min = min(lon_min, lon)
-                lon_max = max(lon_max, lon)
-
-        for y in range(0, y_size, sample_rate):
-            for x in [0, x_size - 1]:  # left and right edges
-                # Get pixel (x, y) coordinates in dataset's projection
-                x_geo = geotransform[0] + x * geotransform[1]
-                y_geo = geotransform[3] + y * geotransform[5]
-
-                # Transform the coordinates to lat/lon
-                lon, lat, _ = transform.TransformPoint(x_geo, y_geo)
-
-                # Update min/max lat and lon
-                lat_min = min(lat_min, lat)
-                lat_max = max(lat_max, lat)
-                lon_min = min(lon_min, lon)
-                lon_max = max(lon_max, lon)
-
-    print([lat_min, lon_min, lat_max, lon_max])
-    extent = [lat_min, lon_min, lat_max, lon_max]
-    
-    #export file
-    if (output_file != None or export_json == True):
-        print("exported")
-        saveToJSON(extent, output_file, model)
+        image = PIL.Image.fromarray(np.ascontiguousarray(rgb_array))
 
-        # Return the extent in lon/lat
-    return extent
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", lossless=True, method=method, quality=quality, exact=exact)
+    return buffer.getvalue()
+
+def saveBytes(filepath, data):
+    """
+    Write a file in a single write, through a temporary file renamed once complete
+    """
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    #temporary file unique to the writer, so concurrent writers of the same file don't mix their data
+    tempPath = filepath + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".part"
+    with open(tempPath, "wb") as f:
+        f.write(data)
+    os.replace(tempPath, filepath)
+
+def tilesPath(file):
+    """
+    Folder of the tile pyramid of an output file (its manifest is this path + ".json")
+    """
+    return ".".join(file.split(".")[:-1]) + ".tiles"
+
+def exportTiles(file, rgb_array, extent, nodata, settings=None):
+    """
+    Write a reprojected band as an equirectangular (EPSG:4326) tile pyramid with its manifest
+
+    The most detailed zoom level is the band itself, each lower level keeps every other pixel
+    of the next one (no averaging, so the packed 24-bit values stay decodable by the client).
+    Tiles are tile_size pixels, padded with nodata, written as lossless WebP in
+    tilesPath(file)/{z}/{x}/{y}.webp. Tiles holding only nodata are skipped, except for
+    the delta frames of deltaEncode (opaque) where they are tiles that didn't change.
+
+    The manifest (tilesPath(file) + ".json") holds the extent, the top-left origin, and for each zoom
+    level its size and pixel size in degrees and the list of the [x, y] tiles written.
+
+    Parameters:
+    file (str): output file of the band (frame layout)
+    rgb_array (np.ndarray): (height, width, 3) uint8 reprojected band covering extent
+    extent (list): [xmin, ymin, xmax, ymax] in lon/lat
+    nodata: value of the pixels without data
+    settings (dict): (optional) WebP method, quality, exact and opaque (see exportBands)
+
+    Returns:
+    str: the manifest file
+    """
+    if (settings == None):
+        settings = {}
+    folder = tilesPath(file)
+    rows, cols, _ = rgb_array.shape
+    pixelWidth = (extent[2] - extent[0]) / cols
+    pixelHeight = (extent[3] - extent[1]) / rows
+
+    levels = []
+    level = rgb_array
+    for z in reversed(range(tile_zoom_levels)):
+        rows, cols, _ = level.shape
+        scale = 2 ** (tile_zoom_levels - 1 - z)
+        tiles = []
+        for y in range(math.ceil(rows / tile_size)):
+            for x in range(math.ceil(cols / tile_size)):
+                tile = level[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+                #in a delta frame (opaque) zero codes mean no change, every tile is kept
+                if (not settings.get("opaque") and np.all(tile == nodata)):
+                    continue
+                if (tile.shape[:2] != (tile_size, tile_size)):
+                    padded = np.full((tile_size, tile_size, 3), nodata, dtype=np.uint8)
+                    padded[:tile.shape[0], :tile.shape[1]] = tile
+                    tile = padded
+                saveBytes(os.path.join(folder, str(z), str(x), str(y) + ".webp"), encodeWEBP(tile, None if settings.get("opaque") else nodata, settings.get("method"), settings.get("quality"), settings.get("exact", False)))
+                tiles.append([x, y])
+
+        levels.insert(0, {"z": z,
+                          "width": cols,
+                          "height": rows,
+                          "pixelSize": [pixelWidth * scale, pixelHeight * scale],
+                          "tiles": tiles})
+        level = level[::2, ::2]
+
+    manifest = {"extent": list(extent),
+                "origin": [extent[0], extent[3]],
+                "tileSize": tile_size,
+                "nodata": nodata,
+                "levels": levels}
+    saveBytes(folder + ".json", json.dumps(manifest).encode())
+    return folder + ".json"
+
+#codes of the last frame encoded of each variable with deltaEncode, by (run folder, variable, level)
+deltaHistory = {}
+maxDeltaHistory = 64
+deltaLock = threading.Lock()
+
+def rgbToCodes(rgb_array, bits=24):
+    """
+    Codes packed in an rgb array by float_to_rgb (uint32)
+    """
+    if (bits == 24):
+        return (rgb_array[..., 0].astype(np.uint32) << 16) | (rgb_array[..., 1].astype(np.uint32) << 8) | rgb_array[..., 2]
+    elif (bits == 16):
+        return (rgb_array[..., 0].astype(np.uint32) << 8) | rgb_array[..., 1]
+    return rgb_array[..., 0].astype(np.uint32)
+
+def codesToRGB(codes, bits=24, out=None):
+    """
+    Pack codes in an rgb array the same way as float_to_rgb
+    """
+    if (out is None):
+        out = np.empty(codes.shape + (3,), dtype=np.uint8)
+    if (bits == 24):
+        out[..., 0] = codes >> 16
+        out[..., 1] = (codes >> 8) & 255
+        out[..., 2] = codes & 255
+    elif (bits == 16):
+        out[..., 0] = codes >> 8
+        out[..., 1] = codes & 255
+        out[..., 2] = 0
+    else:
+        for channel in range(3):
+            out[..., channel] = codes
+    return out
+
+def deltaEncode(key, forecastSeconds, rgb_array, bits=24):
+    """
+    Encode a frame as the difference with the previous frame of the same variable
+
+    A frame is a keyframe (left as is) every delta_keyframe_interval frames, or when the previous
+    frame converted of the variable isn't an earlier forecast. Otherwise the codes are replaced,
+    in rgb_array, by their difference with the codes of the previous frame modulo 2^bits, as a
+    zigzag integer (0, -1, 1, -2, 2... become 0, 1, 2, 3, 4...) so small changes have only low
+    bits and the unchanged areas are constant, which lossless WebP compresses far better.
+
+    To decode: signed = (zigzag >> 1) ^ -(zigzag & 1) and code = (reference code + signed) mod 2^bits,
+    the reference being the decoded codes of the frame at forecast seconds "reference".
+
+    Parameters:
+    key (tuple): identifies the series of frames (run folder, variable, level)
+    forecastSeconds (int): forecast of the frame
+    rgb_array (np.ndarray): frame given by float_to_rgb, replaced by the deltas for delta frames
+    bits (int): precision of the frame
+
+    Returns:
+    dict: {"encoding": "keyframe"} or {"encoding": "delta", "reference": forecast seconds of the
+          previous frame, "keyframe": forecast seconds of the keyframe of the chain}
+    """
+    codes = rgbToCodes(rgb_array, bits)
+    with deltaLock:
+        previous = deltaHistory.pop(key, None)
+        if (previous != None and previous["forecastSeconds"] < forecastSeconds
+                and previous["chain"] + 1 < delta_keyframe_interval and previous["codes"].shape == codes.shape):
+            mask = 2 ** bits - 1
+            difference = (codes.astype(np.int64) - previous["codes"]) & mask
+            #difference as a signed integer of bits bits, then zigzag
+            signed = difference - ((difference >> (bits - 1)) & 1) * (mask + 1)
+            zigzag = ((signed << 1) ^ (signed >> 63)) & mask
+            codesToRGB(zigzag, bits, out=rgb_array)
+            encoding = {"encoding": "delta", "reference": previous["forecastSeconds"], "keyframe": previous["keyframe"]}
+            chain = previous["chain"] + 1
+            keyframe = previous["keyframe"]
+        else:
+            encoding = {"encoding": "keyframe"}
+            chain = 0
+            keyframe = forecastSeconds
+
+        deltaHistory[key] = {"forecastSeconds": forecastSeconds, "codes": codes, "chain": chain, "keyframe": keyframe}
+        if (len(deltaHistory) > maxDeltaHistory):
+            deltaHistory.pop(next(iter(deltaHistory)))
+    return encoding
+
+#indexes of the time-series packs recently appended to, by pack file
+packIndexes = {}
+maxPackIndexes = 256
+packLock = threading.Lock()
+
+def packPath(exportFile, variable, level):
+    """
+    Time-series pack of a variable and level, in the folder of the run of exportFile
+    """
+    return os.path.join(os.path.dirname(exportFile), variable + "." + level + ".pack")
+
+def appendToPack(packFile, frame, data):
+    """
+    Append an encoded frame to the time-series pack of a variable
+
+    The pack is the concatenation of the WebP files of the frames in the order they were converted,
+    its index (packFile + ".json") lists the frames sorted by forecast time with their offset and
+    length in the pack, so the client can get a whole loop in one request. The data is appended
+    before the index is replaced, so the index only points to complete frames. A frame converted
+    again replaces its previous entry.
+
+    Parameters:
+    packFile (str): pack file
+    frame (dict): frame metadata, must contain forecastSeconds
+    data (bytes): encoded frame
+
+    Returns:
+    dict: the index of the pack
+    """
+    with packLock:
+        index = packIndexes.pop(packFile, None)
+        if (index == None):
+            index = {"format": "webp", "frames": []}
+            if (os.path.exists(packFile) and os.path.exists(packFile + ".json")):
+                with open(packFile + ".json", "r") as f:
+                    index = json.load(f)
+
+        os.makedirs(os.path.dirname(packFile) or ".", exist_ok=True)
+        with open(packFile, "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+
+        entry = dict(frame)
+        entry["offset"] = offset
+        entry["length"] = len(data)
+        index["frames"] = [f for f in index["frames"] if f["forecastSeconds"] != frame["forecastSeconds"]] + [entry]
+        index["frames"].sort(key=lambda f: f["forecastSeconds"])
+        saveBytes(packFile + ".json", json.dumps(index).encode())
+
+        packIndexes[packFile] = index
+        if (len(packIndexes) > maxPackIndexes):
+            packIndexes.pop(next(iter(packIndexes)))
+        return index
+
+def warpBands(rgbArrays, geotransform, projection, extent, width, height, nodata, out=None):
+    """
+    Reproject rgb arrays of the same source grid to EPSG:4326 in a single pass
+
+    The arrays are stacked as the channels of one array (one multi-band dataset without
+    the reprojection cache) so the transformer setup and the reads are done once for all bands.
+
+    Parameters:
+    rgbArrays (list): (rows, cols, 3) uint8 arrays of the source grid
+    geotransform, projection: georeferencing of the source grid
+    extent (list): output bounds [xmin, ymin, xmax, ymax] in lon/lat
+    width, height (int): output size in pixels
+    nodata: value of the output pixels outside of the source grid
+    out (np.ndarray): (optional) preallocated output
+
+    Returns:
+    np.ndarray: (height, width, 3*len(rgbArrays)) array, band i in channels 3*i to 3*i+2
+    """
+    if (len(rgbArrays) == 1):
+        stack = rgbArrays[0]
+    else:
+        stack = np.concatenate(rgbArrays, axis=2)
+    rows, cols, channels = stack.shape
+
+    if (use_reprojection_cache):
+        reprojectionMap = getReprojectionMap(geotransform, projection, (rows, cols), extent, width, height)
+        return remapArray(stack, reprojectionMap, nodata, out=out)
+
+    # Create an in-memory dataset to hold the RGB data of every band
+    driver = gdal.GetDriverByName('MEM')
+    rgb_dataset = driver.Create('', cols, rows, channels, gdal.GDT_Byte)
+
+    # Inject the geotransform and projection into the new dataset
+    rgb_dataset.SetGeoTransform(geotransform)
+    rgb_dataset.SetProjection(projection)
+
+    for i in range(channels):
+        rgb_dataset.GetRasterBand(i + 1).WriteArray(stack[:, :, i])
+
+    warped = gdal.Warp(
+        '',
+        rgb_dataset,
+        dstSRS="EPSG:4326",
+        outputBounds=extent,
+        width=width,
+        height=height,
+        outputType=gdal.GDT_Byte,
+        dstNodata=nodata,
+        format="MEM"
+    )
+
+    if (out is None):
+        out = np.empty((height, width, channels), dtype=np.uint8)
+    for i in range(channels):
+        out[:, :, i] = warped.GetRasterBand(i + 1).ReadAsArray()
+
+    #close datasets
+    warped = None
+    rgb_dataset = None
+    return out
+
+def saveWarpedPNG(filepath, rgb_array, extent, nodata):
+    """
+    Write an array in EPSG:4326 covering extent to a PNG (same file as gdal.Warp to PNG gave)
+
+    Parameters:
+    filepath (str): output PNG
+    rgb_array (np.ndarray): (height, width, bands) uint8 array
+    extent (list): [xmin, ymin, xmax, ymax] in lon/lat
+    nodata: nodata value of the bands
+    """
+    rows, cols, bands = rgb_array.shape
+    driver = gdal.GetDriverByName('MEM')
+    dataset = driver.Create('', cols, rows, bands, gdal.GDT_Byte)
+    dataset.SetGeoTransform([extent[0], (extent[2] - extent[0]) / cols, 0, extent[3], 0, -(extent[3] - extent[1]) / rows])
+    target_proj = osr.SpatialReference()
+    target_proj.ImportFromEPSG(4326)
+    dataset.SetProjection(target_proj.ExportToWkt())
+    for i in range(bands):
+        bandObj = dataset.GetRasterBand(i + 1)
+        bandObj.WriteArray(rgb_array[:, :, i])
+        bandObj.SetNoDataValue(nodata)
+    gdal.GetDriverByName('PNG').CreateCopy(filepath, dataset, options=['ZLEVEL=1'])
+    dataset = None
 
 def calculateAspectRatio(extent):
     """
@@ -275,17 +1063,152 @@ def calculateAspectRatio(extent):
     
     return aspect_ratio
 
+def modelServer(sharedModel=None):
+    """
+    Server the model was downloaded from (sharedModel.server), NOMADS if unknown
+    """
+    try:
+        return sharedModel.server
+    except BaseException:
+        #Model objects raise BaseException for undefined attributes
+        return "NOMADS"
+
+def gribInventory(dataset, server=None):
+    """
+    Index the bands of a GRIB2 dataset in one pass (each band's metadata is read once)
+
+    Parameters:
+    dataset (gdal.Dataset): opened GRIB2 file
+    server (str): server the file comes from, for the level names of formatMetadata
+
+    Returns:
+    list: a dict per band, in band order, with
+          band (int): band number
+          element (str): GRIB_ELEMENT (variable)
+          description (str): band description
+          level (str): level name as in variables{MODEL} (None if formatMetadata doesn't know it)
+          forecastSeconds (int): GRIB_FORECAST_SECONDS
+          refTime, validTime (str): GRIB_REF_TIME and GRIB_VALID_TIME
+    """
+    inventory = []
+    for band in range(1, dataset.RasterCount + 1):
+        bandObj = dataset.GetRasterBand(band)
+        metadata = bandObj.GetMetadata()
+        description = bandObj.GetDescription()
+        try:
+            level = formatMetadata(description, server)
+        except Exception:
+            #level not implemented, can only be converted without variablesToConvert
+            level = None
+        inventory.append({"band": band,
+                          "element": metadata.get('GRIB_ELEMENT'),
+                          "description": description,
+                          "level": level,
+                          #older GDAL versions write "3600 sec"
+                          "forecastSeconds": int(metadata.get('GRIB_FORECAST_SECONDS', "0").split()[0]),
+                          "refTime": metadata.get('GRIB_REF_TIME'),
+                          "validTime": metadata.get('GRIB_VALID_TIME')})
+    return inventory
+
+def selectBands(inventory, variablesToConvert=None):
+    """
+    Bands of an inventory to convert, matched against the requested variables and levels
+
+    Parameters:
+    inventory (list): from gribInventory
+    variablesToConvert (dict): variables and their levels to convert (as variables{MODEL}),
+                               a level "all_lev" takes every level, None takes every band
+
+    Returns:
+    list: (variable, level, band dict of the inventory, index of the band among the bands of its variable)
+          grouped by variable in the order of the file
+    """
+    if (variablesToConvert != None):
+        requestedLevels = {variable: set(levels) for variable, levels in variablesToConvert.items()}
+
+    bandsByVariable = {}
+    for bandInfo in inventory:
+        variable = bandInfo["element"]
+        if not (variable):
+            continue
+        if (variablesToConvert == None):
+            # Replace non-alphabetic characters with underscores for file format
+            level = re.sub(r'[^a-zA-Z]', '_', bandInfo["description"])
+        else:
+            levels = requestedLevels.get(variable)
+            if (levels == None):
+                continue
+            if ("all_lev" in levels):
+                level = "all_lev"
+            elif (bandInfo["level"] in levels):
+                level = bandInfo["level"]
+            else:
+                continue
+        bandsByVariable.setdefault(variable, []).append((level, bandInfo))
+
+    selected = []
+    for variable in bandsByVariable:
+        for forecast, (level, bandInfo) in enumerate(bandsByVariable[variable]):
+            selected.append((variable, level, bandInfo, forecast))
+    return selected
+
+def selectDerived(inventory, requested):
+    """
+    Derived products to compute for each forecast of an inventory (see derived.py)
+
+    Parameters:
+    inventory (list): from gribInventory
+    requested (dict): products and their levels, e.g. {"WIND": ["lev_10_m_above_ground"]}
+
+    Returns:
+    list: (product, level, band dict, index of the forecast in the file) as selectBands,
+          the band dict having the times of the forecast and band None
+    """
+    forecasts = {}
+    for bandInfo in inventory:
+        forecasts.setdefault(bandInfo["forecastSeconds"], bandInfo)
+
+    selected = []
+    for forecast, forecastSeconds in enumerate(sorted(forecasts)):
+        for product in requested:
+            for level in requested[product]:
+                selected.append((product, level, {"band": None,
+                                                  "element": product,
+                                                  "description": product,
+                                                  "level": level,
+                                                  "forecastSeconds": forecastSeconds,
+                                                  "refTime": forecasts[forecastSeconds]["refTime"],
+                                                  "validTime": forecasts[forecastSeconds]["validTime"]}, forecast))
+    return selected
+
+def derivedInputLoader(sources, forecastSeconds):
+    """
+    Function reading the inputs of the derived products of a forecast (loadBand of derived.DerivedFields)
+
+    Parameters:
+    sources (list): (dataset, inventory from gribInventory) of the files of the forecast hour
+    forecastSeconds (int): forecast of the inputs
+    """
+    bands = {}
+    for dataset, inventory in sources:
+        for bandInfo in inventory:
+            if (bandInfo["forecastSeconds"] == forecastSeconds):
+                bands.setdefault((bandInfo["element"], bandInfo["level"]), (dataset, bandInfo["band"]))
+
+    def loadBand(variable, level):
+        source = bands.get((variable, level))
+        if (source == None):
+            return None
+        return readBand(source[0].GetRasterBand(source[1]))
+    return loadBand
+
 def formatMetadata(metadata, server=None, sharedModel=None):
     #format grib getDescription into downloaded level (here we don't take into account the lev_)
     #Height above ground level
 
     #try asking Model object its server, otherwise defaults to NOMADS
     if (server==None):
-        try:
-            server = sharedModel.server
-        except:
-            server = "NOMADS"
-    print(server)
+        server = modelServer(sharedModel)
     if (server == "NOMADS"):
         if "HTGL" in metadata:
             formatted = metadata.replace('[m]', '_m')
@@ -327,14 +1250,20 @@ def formatMetadata(metadata, server=None, sharedModel=None):
     else:
         raise Exception("Server not yet implemented")
 
-def decodeJSON(band, exportPath, variable, level, vmin, vmax):
+def decodeJSON(bandInfo, exportPath, variable, level, vmin, vmax, bits=24, step=None, encoding=None):
+    #bandInfo: band of gribInventory
     fullExportFile = exportPath + variable + "." + level + ".json"
     data = {
         "vmin": vmin,
         "vmax": vmax,
-        "run": band.GetMetadata()['GRIB_REF_TIME'],
-        "forecastTime":  band.GetMetadata()['GRIB_VALID_TIME']
+        "run": bandInfo["refTime"],
+        "forecastTime":  bandInfo["validTime"],
+        #value = vmin + code * step, code being packed in R (8 bits), R and G (16 bits) or R, G and B (24 bits)
+        "precision": bits,
+        "step": precisionStep(vmin, vmax, bits, step)
     }
+    if (encoding != None):
+        data["encoding"] = encoding
     os.makedirs(os.path.dirname(fullExportFile), exist_ok=True)
     with open(fullExportFile, 'w') as f:
         json.dump(data, f, indent=0)
@@ -460,9 +1389,144 @@ def decodeCanadianRadar(filename):
         pass
     return radar
 
-def convertFromNCToPNG(inputFile="input.tif", exportPath="./", variablesToConvert=None, extent=None, vmin=0, vmax=10, nodata=None, model=None, width=None, jsonOutput=True, sharedModel=None):
+def outputSize(extent, width=None):
+    """
+    Size in pixels (width, height) of an output covering extent, file_width_resolution wide if width is None
+    """
+    # determine height
+    if (width != None):
+        width_resolution = width
+    else:
+        width_resolution = file_width_resolution
+    height_resolution = width_resolution/calculateAspectRatio(extent)
+    return int(abs(width_resolution)), int(abs(height_resolution))
+
+def exportBands(files, rgbArrays, geotransform, projection, extent, width, nodata, out=None, settings=None, encoded=None):
+    """
+    Reproject encoded bands in one pass (warpBands) and write each one to its file
+
+    Files ending with .webp are encoded in memory with encodeWEBP, the others are written as PNG.
+
+    Parameters:
+    files (list): output file of each band
+    rgbArrays (list): (rows, cols, 3) uint8 array of each band
+    geotransform, projection: georeferencing of the source grid
+    extent (list): output bounds [xmin, ymin, xmax, ymax] in lon/lat
+    width (int): output width (file_width_resolution if None), the height follows the extent
+    nodata: nodata value of the outputs
+    out (np.ndarray): (optional) reusable output buffer
+    settings (list): (optional) WebP settings of each band, dicts with method, quality, exact
+                     and opaque (no transparent nodata)
+    encoded (dict): (optional) filled with the WebP bytes written, by file
+
+    Returns:
+    np.ndarray: the reprojected bands (can be given back as out)
+    """
+    width_resolution, height_resolution = outputSize(extent, width)
+
+    if (out is not None and out.shape != (height_resolution, width_resolution, 3 * len(rgbArrays))):
+        out = None
+    warped = warpBands(rgbArrays, geotransform, projection, extent, width_resolution, height_resolution, nodata, out=out)
+
+    for i in range(len(files)):
+        bandSettings = settings[i] if (settings != None and settings[i] != None) else {}
+        if (output_layout in ["tiles", "both"]):
+            print("exported: " + exportTiles(files[i], warped[:, :, 3 * i:3 * i + 3], extent, nodata, bandSettings))
+        if (output_layout == "tiles"):
+            continue
+        if (files[i].endswith(".webp")):
+            data = encodeWEBP(warped[:, :, 3 * i:3 * i + 3], None if bandSettings.get("opaque") else nodata, bandSettings.get("method"), bandSettings.get("quality"), bandSettings.get("exact", False))
+            saveBytes(files[i], data)
+            if (encoded != None):
+                encoded[files[i]] = data
+        else:
+            saveWarpedPNG(files[i], warped[:, :, 3 * i:3 * i + 3], extent, nodata)
+        print("exported: " + files[i])
+    return warped
+
+conversionPool = None
+conversionPoolLock = threading.Lock()
+
+def getConversionPool():
+    """
+    Process pool shared by all the conversions (created on first use with conversion_workers processes)
+    """
+    global conversionPool
+    with conversionPoolLock:
+        if (conversionPool == None):
+            #workers must share the resource tracker of this process, otherwise they unlink
+            #the shared memory blocks they attached to when they exit
+            if (os.name != "nt"):
+                resource_tracker.ensure_running()
+            conversionPool = ProcessPoolExecutor(max_workers=conversion_workers)
+        return conversionPool
+
+def convertBandWorker(job):
+    """
+    Convert a band in a worker process: float_to_rgb, reprojection and export of its file
+
+    Parameters:
+    job (dict): band description from submitBand, its data is read from the shared memory block job["sharedMemory"]
+
+    Returns:
+    (str, bytes): the exported file and its WebP bytes if job["keepEncoded"] (None otherwise)
+    """
+    globals().update(job["settings"])
+    sharedBlock = shared_memory.SharedMemory(name=job["sharedMemory"])
+    try:
+        data_array = np.ndarray(job["shape"], dtype=job["dtype"], buffer=sharedBlock.buf)
+        if (job["packed"]):
+            rgb_array = data_array
+        else:
+            rgb_array = float_to_rgb(data_array, job["vmin"], job["vmax"], bits=job["bits"], step=job["step"])
+        data_array = None
+        encoded = {}
+        exportBands([job["file"]], [rgb_array], job["geotransform"], job["projection"], job["extent"], job["width"], job["nodata"], settings=[job["webpSettings"]], encoded=encoded)
+        rgb_array = None
+        reportMemory("worker " + str(os.getpid()) + " band " + job["file"])
+    finally:
+        sharedBlock.close()
+    return job["file"], encoded.get(job["file"]) if job["keepEncoded"] else None
+
+def submitBand(data_array, vmin, vmax, file, geotransform, projection, extent, width, nodata, webpSettings=None, bits=24, step=None, packed=False):
+    """
+    Copy a band to shared memory and submit its conversion to the process pool
+
+    With packed, data_array is the rgb array already given by float_to_rgb (only reprojected and exported).
+
+    Returns:
+    tuple: (future, shared memory block), the block has to be released (releaseBand) once the future is done
+    """
+    sharedBlock = shared_memory.SharedMemory(create=True, size=max(data_array.nbytes, 1))
+    np.ndarray(data_array.shape, dtype=data_array.dtype, buffer=sharedBlock.buf)[...] = data_array
+    job = {"sharedMemory": sharedBlock.name,
+           "shape": data_array.shape,
+           "dtype": data_array.dtype.str,
+           "vmin": vmin,
+           "vmax": vmax,
+           "bits": bits,
+           "step": step,
+           "packed": packed,
+           "file": file,
+           "geotransform": geotransform,
+           "projection": projection,
+           "extent": extent,
+           "width": width,
+           "nodata": nodata,
+           "webpSettings": webpSettings,
+           "keepEncoded": pack_time_series,
+           "settings": {name: globals()[name] for name in conversion_worker_settings}
+           }
+    return getConversionPool().submit(convertBandWorker, job), sharedBlock
+
+def releaseBand(sharedBlock):
+    sharedBlock.close()
+    sharedBlock.unlink()
+
+def convertFromNCToPNG(inputFile="input.tif", exportPath="./", variablesToConvert=None, extent=None, vmin=0, vmax=10, nodata=None, model=None, width=None, jsonOutput=True, sharedModel=None, webpSettings=None, precision=None, manifest=None, deltaVariables=None, derivedVariables=None, derivedFiles=None):
     '''
-    Converts a NetCDF (or GeoTIFF) file to a 256 base PNG.
+    Converts a NetCDF (or GeoTIFF) file to a 256 base PNG (or directly to a lossless WebP
+    if output_format is "webp").
 
     This function processes all bands in the raster to png.
     If variablesToConvert has a dict containing variables and a level to it,
@@ -488,8 +1552,17 @@ def convertFromNCToPNG(inputFile="input.tif", exportPath="./", variablesToConver
                  if extent not set, model use for render setting the extent
                  in a file and naming it
     sharedModel (object): (optional) used for formatMetadata to get server from model object, defaults to NOMADS
+    webpSettings (dict): (optional) WebP encoder settings by variable, e.g. {"REFC": {"method": 6, "quality": 100}}
+    precision (dict): (optional) precision by variable, e.g. {"REFC": {"bits": 8, "step": 0.5}}, others are 24-bit over vmin-vmax
+    manifest (RunManifest): (optional) manifest of the run in which the converted bands are recorded
+                            (jsonOutput writes a JSON next to every image instead)
+    deltaVariables (list): (optional) variables encoded as deltas against their previous forecast (see deltaEncode)
+    derivedVariables (dict): (optional) derived products and their levels (see derived.py), computed for
+                             each forecast of the file from its bands then converted as the other variables
+    derivedFiles (list): (optional) other GRIB2 files of the same forecast hour and grid holding inputs of
+                         the derived products (models published as one file per variable)
     Returns:
-    filepath (list): filepath of rendered images.
+    filepath (list): filepath of rendered images (tile manifests with output_layout "tiles").
     '''
 
     #benchmark time
@@ -498,25 +1571,27 @@ def convertFromNCToPNG(inputFile="input.tif", exportPath="./", variablesToConver
 
     dataset = gdal.Open(inputFile)
 
-    #get all rasterBands for a variable -----------------------
+    #index the bands of the file in one pass -----------------
     
-    variablesDict = {}
     #check file extension
     filetype = inputFile.split(".")[-1]
     if filetype == "grib2":
-        # Iterate through all bands in the dataset
-        for band in range(1, dataset.RasterCount + 1):
-            metadata = dataset.GetRasterBand(band).GetMetadata()
-        
-            # Retrieve 'GRIB_ELEMENT' from metadata
-            desc = metadata.get('GRIB_ELEMENT')
-            if desc:  
-                variablesDict.setdefault(desc, []).append(band)
-
-        
+        inventory = gribInventory(dataset, modelServer(sharedModel))
     else:
         #note: possibely change the code in future to do the export sequentially
         raise Exception("filetype not recognised: " + filetype)
+    selectedBands = selectBands(inventory, variablesToConvert)
+    #derived products after the bands, which are kept as inputs when read
+    derivedFields = {}
+    if (derivedVariables != None and len(derivedVariables) > 0):
+        selectedBands += selectDerived(inventory, derivedVariables)
+        derivedSources = [(dataset, inventory)]
+        for derivedFile in (derivedFiles or []):
+            if (os.path.normpath(derivedFile) != os.path.normpath(inputFile)):
+                derivedDataset = gdal.Open(derivedFile)
+                derivedSources.append((derivedDataset, gribInventory(derivedDataset, modelServer(sharedModel))))
+        for forecastSeconds in set(bandInfo["forecastSeconds"] for bandInfo in inventory):
+            derivedFields[forecastSeconds] = derived.DerivedFields(derivedVariables, derivedInputLoader(derivedSources, forecastSeconds))
     
     #----------------------------------------------------------
 
@@ -529,7 +1604,7 @@ def convertFromNCToPNG(inputFile="input.tif", exportPath="./", variablesToConver
 
     if (model == "HRRRSH"):
         #if hrrrsh run is at zero, than only one forecast
-        if (int(dataset.GetRasterBand(band).GetMetadata()['GRIB_FORECAST_SECONDS']) != 0):
+        if (len(inventory) > 0 and inventory[-1]["forecastSeconds"] != 0):
             numbersOfForecast = 4
         else:
             numbersOfForecast = 1
@@ -537,114 +1612,173 @@ def convertFromNCToPNG(inputFile="input.tif", exportPath="./", variablesToConver
         numbersOfForecast = 1
 
     allRenderedFiles = []
-    for variable in variablesDict:
-        forecast=0
-        for band in variablesDict[variable]:
-                bandObj = dataset.GetRasterBand(band)
-                # checks whether it's all_lev in which case continue the conversion
-                # otherwise the level is not wanted so go to next band
-                #print(variable + str(variablesToConvert[variable]))
-                if not (variablesToConvert==None):
-                    #if formatMetadata fails, then skip
-                    try:
-                        if ("all_lev" in variablesToConvert[variable]):
-                            level = "all_lev"
-                        #checks if current level is in the list to convert otherwise break
-                        elif not (formatMetadata(bandObj.GetDescription(), sharedModel=sharedModel) in variablesToConvert[variable]):
-                            continue
-                        level = variablesToConvert[variable][0]
-                    except:
-                        continue
-                else: 
-                    # Replace non-alphabetic characters with underscores for file format
-                    level = re.sub(r'[^a-zA-Z]', '_', bandObj.GetDescription())
-            
+    #float32 buffer of the band read, reused between the bands
+    read_buffer = None
+    #rgb buffer reused by float_to_rgb between the bands
+    rgb_buffer = None
+    warped_buffer = None
+    peakMemory = reportMemory("opening " + inputFile)
+    #bands encoded but not exported yet
+    pendingFiles = []
+    pendingArrays = []
+    pendingSettings = []
+    #(future, shared memory) of the bands converted by the process pool
+    pendingJobs = []
+    #WebP bytes of the exported files and pack (file, frame) of each band with pack_time_series
+    encoded = {} if (pack_time_series) else None
+    packFrames = {}
+    #bands recorded in the manifest once exported
+    manifestBands = []
+    for variable, level, bandInfo, forecast in selectedBands:
+        band = bandInfo["band"]
+        if (band == None):
+            #derived product, computed from its inputs of the same forecast
+            data_array = derivedFields[bandInfo["forecastSeconds"]].get(variable, level)
+            if (data_array is None):
+                print("inputs of " + variable + " " + level + " not found in the files of the forecast")
+                continue
+            band = variable + "." + level
+        else:
+            bandObj = dataset.GetRasterBand(band)
+            read_buffer = readBand(bandObj, read_buffer)
+            data_array = read_buffer
+            if (bandInfo["forecastSeconds"] in derivedFields):
+                derivedFields[bandInfo["forecastSeconds"]].offer(variable, level, data_array)
+        if (model=="HRRRSH"):
+            fullExportFile = exportPath + str(int(forecast*(60/numbersOfForecast))).zfill(2) + "." + variable + "." + level + "." + output_format
+        else:
+            fullExportFile = exportPath + variable + "." + level + "." + output_format
+        if (output_layout == "tiles"):
+            allRenderedFiles.append(tilesPath(fullExportFile) + ".json")
+        else:
+            allRenderedFiles.append(fullExportFile)
 
+        if nodata==None:
+            #in case of inverted colormaps
+            if variable=="CIN":
+                nodata=255
+            else:
+                nodata=0
 
-                data_array = bandObj.ReadAsArray().astype(float)
-                if (model=="HRRRSH"):
-                    fullExportFile = exportPath + str(int(forecast*(60/numbersOfForecast))).zfill(2) + "." + variable + "." + level + ".png"
-                else:
-                    fullExportFile = exportPath + variable + "." + level + ".png"
-                allRenderedFiles.append(fullExportFile)
-
-                if nodata==None:
-                    #in case of inverted colormaps
-                    if variable=="CIN":
-                        nodata=255
-                    else:
-                        nodata=0
-
-                #arrange array to rgb standards
-                #check if vmin is dict
-
-                if (model=="HRRRSH"):
-                    exportPathJSON = exportPath + str(int(forecast*(60/numbersOfForecast))).zfill(2) + "."
-                else:
-                    exportPathJSON = exportPath
-
-                if (isinstance(vmin, dict) and isinstance(vmax, dict)):
-                    rgb_array = float_to_rgb(data_array, vmin[variable], vmax[variable])
-                    if jsonOutput:
-                        decodeJSON(bandObj, exportPathJSON, variable, level, vmin[variable], vmax[variable])
-                else:
-                    rgb_array = float_to_rgb(data_array, vmin, vmax)
-                    if jsonOutput:
-                        decodeJSON(bandObj, exportPathJSON, variable, level, vmin, vmax)
-
-                if (extent==None):
-                    extent = get_raster_extent_in_lonlat(dataset, model)
-
-                # Create an in-memory dataset to hold the RGB data
-                driver = gdal.GetDriverByName('MEM')
-                rows, cols, _ = rgb_array.shape
-                rgb_dataset = driver.Create('', cols, rows, 3, gdal.GDT_Byte)
-    
-                # Inject the geotransform and projection into the new dataset
-                rgb_dataset.SetGeoTransform(geotransform)
-                rgb_dataset.SetProjection(projection)
-    
-                # Write the RGB bands to the dataset
-                for i in range(3):  # R, G, B
-                    rgb_dataset.GetRasterBand(i + 1).WriteArray(rgb_array[:, :, i])
-    
-                # determine height
-                if (width != None):
-                    width_resolution = width
-                else:
-                    width_resolution = file_width_resolution
-            
+        #arrange array to rgb standards
+        #check if vmin is dict
 
-                height_resolution = width_resolution/calculateAspectRatio(extent)
+        if (model=="HRRRSH"):
+            exportPathJSON = exportPath + str(int(forecast*(60/numbersOfForecast))).zfill(2) + "."
+        else:
+            exportPathJSON = exportPath
 
-                gdal.Warp(
-                    fullExportFile,
-                    rgb_dataset,
-                    dstSRS="EPSG:4326",
-                    outputBounds=extent,
-                    width=int(abs(width_resolution)),
-                    height=int(abs(height_resolution)),
-                    outputType=gdal.GDT_Byte,
-                    dstNodata=nodata,
-                    creationOptions=['ZLEVEL=1'],
-                    format="PNG"
-                )
+        if (isinstance(vmin, dict) and isinstance(vmax, dict)):
+            bandVmin, bandVmax = vmin[variable], vmax[variable]
+        else:
+            bandVmin, bandVmax = vmin, vmax
+        bandPrecision = precision.get(variable, {}) if (precision != None) else {}
+        bandBits = bandPrecision.get("bits", 24)
+        bandStep = bandPrecision.get("step")
+
+        if (extent==None):
+            extent = get_raster_extent_in_lonlat(dataset, model)
+
+        bandSettings = webpSettings.get(variable) if (webpSettings != None) else None
+        isDelta = (deltaVariables != None and variable in deltaVariables)
+
+        #encoded here unless the process pool does it (deltas need the previous frame kept in this process)
+        rgb_array = None
+        if (conversion_workers == 0 or isDelta):
+            if (rgb_buffer is None or rgb_buffer.shape[:2] != data_array.shape):
+                rgb_buffer = np.empty(data_array.shape + (3,), dtype=np.uint8)
+            rgb_array = float_to_rgb(data_array, bandVmin, bandVmax, out=rgb_buffer, bits=bandBits, step=bandStep)
+
+        bandEncoding = None
+        if (isDelta):
+            bandEncoding = deltaEncode((os.path.dirname(fullExportFile), variable, level), bandInfo["forecastSeconds"], rgb_array, bandBits)
+            #the client rebuilds the values from the exact rgb of every frame
+            bandSettings = dict(bandSettings) if (bandSettings != None) else {}
+            bandSettings["exact"] = True
+            if (bandEncoding["encoding"] == "delta"):
+                #no transparency, a delta can be equal to nodata
+                bandSettings["opaque"] = True
+
+        #metadata of the band
+        bandFields = {"vmin": bandVmin,
+                      "vmax": bandVmax,
+                      "precision": bandBits,
+                      "step": precisionStep(bandVmin, bandVmax, bandBits, bandStep)}
+        if (bandEncoding != None):
+            bandFields["encoding"] = bandEncoding
+        if jsonOutput:
+            decodeJSON(bandInfo, exportPathJSON, variable, level, bandVmin, bandVmax, bandBits, bandStep, bandEncoding)
+        if (manifest != None):
+            manifest.setExtent(extent)
+            manifestBands.append((bandInfo, variable, level, allRenderedFiles[-1], dict(bandFields)))
+        if (pack_time_series):
+            frame = {"forecastSeconds": bandInfo["forecastSeconds"],
+                     "run": bandInfo["refTime"],
+                     "forecastTime": bandInfo["validTime"]}
+            frame.update(bandFields)
+            packFrames[fullExportFile] = (packPath(fullExportFile, variable, level), frame)
+
+        if (conversion_workers > 0):
+            #the reprojection map is computed here once, the workers read it from the cache
+            if (use_reprojection_cache):
+                getReprojectionMap(geotransform, projection, data_array.shape, extent, *outputSize(extent, width))
+            if (rgb_array is None):
+                pendingJobs.append(submitBand(data_array, bandVmin, bandVmax, fullExportFile, geotransform, projection, extent, width, nodata, bandSettings, bandBits, bandStep))
+            else:
+                pendingJobs.append(submitBand(rgb_array, bandVmin, bandVmax, fullExportFile, geotransform, projection, extent, width, nodata, bandSettings, packed=True))
+            print("submitted band: " + str(band))
+            peakMemory = reportMemory("band " + str(band), peakMemory)
+            continue
+
+        if (batch_conversion):
+            #reprojected with the other bands of the file once all of them are encoded
+            pendingFiles.append(fullExportFile)
+            pendingArrays.append(rgb_array)
+            pendingSettings.append(bandSettings)
+            rgb_buffer = None
+        else:
+            warped_buffer = exportBands([fullExportFile], [rgb_array], geotransform, projection, extent, width, nodata, warped_buffer, [bandSettings], encoded)
 
-                print("exported band: " + str(band))
+        print("encoded band: " + str(band))
+        peakMemory = reportMemory("band " + str(band), peakMemory)
 
-                #close dataset
-                rgb_dataset.FlushCache()
-                rgb_dataset = None
+    if (len(pendingFiles) > 0):
+        exportBands(pendingFiles, pendingArrays, geotransform, projection, extent, width, nodata, settings=pendingSettings, encoded=encoded)
+        peakMemory = reportMemory("exporting " + str(len(pendingFiles)) + " bands", peakMemory)
 
-                #goes to next forecast
-                forecast += 1
+    #wait for the process pool, raising the first error once every shared block is released
+    error = None
+    for future, sharedBlock in pendingJobs:
+        try:
+            file, data = future.result()
+            if (data != None):
+                encoded[file] = data
+        except Exception as e:
+            if (error == None):
+                error = e
+        finally:
+            releaseBand(sharedBlock)
+    if (error != None):
+        raise error
+
+    #frames appended to the time-series packs once written
+    for file in packFrames:
+        if (file in encoded):
+            appendToPack(packFrames[file][0], packFrames[file][1], encoded[file])
+
+    for bandInfo, variable, level, file, fields in manifestBands:
+        #only the frames encoded in memory were appended to their pack (not with tiles or png output)
+        if (file in packFrames and encoded != None and file in encoded):
+            fields["pack"] = os.path.relpath(packFrames[file][0], os.path.dirname(manifest.filepath)).replace(os.sep, "/")
+        manifest.addBand(bandInfo, variable, level, file, **fields)
 
     if (debug):
         end_time = time.time()
         elapsed_time = end_time - start_time
-        print(f"Finished converting '{inputFile}' to PNG: {elapsed_time:.2f} seconds")
+        print(f"Finished converting '{inputFile}' to {output_format.upper()}: {elapsed_time:.2f} seconds")
 
     dataset = None
+    derivedFields = derivedSources = None
     if (len(allRenderedFiles)==1):
         return allRenderedFiles[0]
     else:
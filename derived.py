@@ -0,0 +1,168 @@
+"""
+Derived products computed from the bands of a GRIB2 file (wind speed, dewpoint depression, ...)
+
+A product is declared in derivedProducts by its inputs, bands or other products, and the
+function computing it from their arrays. The products requested for a file are evaluated
+lazily (see DerivedFields): each input is read once, kept while a product still needs it,
+and only the products requested and the products they depend on are computed.
+"""
+import numpy as np
+
+def windSpeed(u, v):
+    """
+    Speed of a wind (or wind shear) from its u and v components
+    """
+    return np.hypot(u, v)
+
+def dewpointDepression(temperature, dewpoint):
+    """
+    Difference between the temperature and the dewpoint
+    """
+    return np.subtract(temperature, dewpoint)
+
+def capeShear(cape, shear):
+    """
+    CAPE (J/kg) times the 0-6 km bulk shear (m/s), the significant severe composite (m3/s3),
+    negative CAPE being 0
+    """
+    return np.maximum(cape, 0) * shear
+
+#derived products: inputs are (variable, level), a variable of the GRIB2 file or another product,
+#the level None being the level at which the product is requested. The function gets the input
+#arrays (float32) in order. Fixed levels are named as the NOMADS filter (lev_...).
+derivedProducts = {"WIND": {"inputs": [("UGRD", None), ("VGRD", None)],
+                            "function": windSpeed},
+                   "DEPR": {"inputs": [("TMP", None), ("DPT", None)],
+                            "function": dewpointDepression},
+                   "SHEAR": {"inputs": [("VUCSH", None), ("VVCSH", None)],
+                             "function": windSpeed},
+                   "CAPESHEAR": {"inputs": [("CAPE", "lev_surface"), ("SHEAR", "lev_0-6000_m_above_ground")],
+                                 "function": capeShear}
+                   }
+
+def productInputs(product, level):
+    """
+    Inputs (variable, level) of a product requested at a level
+    """
+    if (product not in derivedProducts):
+        raise Exception("derived product unknown: " + product)
+    return [(variable, level if (inputLevel == None) else inputLevel) for variable, inputLevel in derivedProducts[product]["inputs"]]
+
+def derivedPlan(requested):
+    """
+    Resolve the dependencies of the requested products
+
+    Parameters:
+    requested (dict): products and their levels (as variables{MODEL}), e.g. {"WIND": ["lev_10_m_above_ground"]}
+
+    Returns:
+    dict: order (list): (product, level) to evaluate, each after its inputs
+          bands (dict): variables and levels of the GRIB2 bands needed (as variables{MODEL})
+          uses (dict): numbers of times each (variable, level) is used, by the products
+                       depending on it and once more if it is requested
+    """
+    order = []
+    bands = {}
+    uses = {}
+    visiting = set()
+
+    def visit(variable, level):
+        uses[(variable, level)] = uses.get((variable, level), 0) + 1
+        if (variable not in derivedProducts):
+            if (level not in bands.setdefault(variable, [])):
+                bands[variable].append(level)
+            return
+        if ((variable, level) in order):
+            return
+        if ((variable, level) in visiting):
+            raise Exception("derived products depend on each other: " + variable + " at " + level)
+        visiting.add((variable, level))
+        for input in productInputs(variable, level):
+            visit(*input)
+        visiting.discard((variable, level))
+        order.append((variable, level))
+
+    for product in requested:
+        for level in requested[product]:
+            visit(product, level)
+    return {"order": order, "bands": bands, "uses": uses}
+
+def requiredBands(requested, variables=None):
+    """
+    Variables to download for the requested products, merged with variables
+
+    Parameters:
+    requested (dict): products and their levels
+    variables (dict): (optional) variables and their levels converted as is (as variables{MODEL})
+
+    Returns:
+    dict: variables and their levels (as variables{MODEL})
+    """
+    merged = {variable: list(levels) for variable, levels in variables.items()} if (variables != None) else {}
+    bands = derivedPlan(requested)["bands"]
+    for variable in bands:
+        for level in bands[variable]:
+            if (level not in merged.setdefault(variable, [])):
+                merged[variable].append(level)
+    return merged
+
+class DerivedFields:
+    """
+    Lazy evaluation of derived products for one forecast
+
+    Inputs are kept (float32) until every product using them is computed, so bands and
+    intermediate products shared by several products are read or computed once.
+
+    Parameters:
+    requested (dict): products and their levels
+    loadBand: function(variable, level) returning the array of a band (None if not in the file)
+    """
+    def __init__(self, requested, loadBand):
+        self.plan = derivedPlan(requested)
+        self.requested = requested
+        self.loadBand = loadBand
+        self.uses = dict(self.plan["uses"])
+        self.cache = {}
+
+    def needs(self, variable, level):
+        return self.uses.get((variable, level), 0) > 0 and (variable, level) not in self.cache
+
+    def offer(self, variable, level, array):
+        """
+        Keep a copy of a band read for another reason if a product needs it
+        """
+        if (self.needs(variable, level)):
+            self.cache[(variable, level)] = np.array(array, dtype=np.float32)
+
+    def _release(self, key):
+        self.uses[key] -= 1
+        if (self.uses[key] <= 0):
+            self.cache.pop(key, None)
+
+    def _value(self, variable, level):
+        key = (variable, level)
+        if (key not in self.cache):
+            if (variable in derivedProducts):
+                inputs = productInputs(variable, level)
+                arrays = [self._value(*input) for input in inputs]
+                if any(array is None for array in arrays):
+                    value = None
+                else:
+                    value = np.asarray(derivedProducts[variable]["function"](*arrays), dtype=np.float32)
+                arrays = None
+                for input in inputs:
+                    self._release(input)
+            else:
+                value = self.loadBand(variable, level)
+                if (value is not None):
+                    value = np.asarray(value, dtype=np.float32)
+            self.cache[key] = value
+        return self.cache[key]
+
+    def get(self, product, level):
+        """
+        Array of a requested product (float32), None if an input is missing from the file
+        """
+        value = self._value(product, level)
+        self._release((product, level))
+        return value
@@ -1,12 +1,24 @@
 from datetime import datetime, timedelta, timezone
-from time import sleep
-import urllib.request
+from time import sleep, monotonic
 from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+import json
+import heapq
+import random
+import collections
+import hashlib
+import shutil
+from contextlib import contextmanager
 import os
 import secret
-import urllib.request
+import urllib.parse
+import http.client
+import ssl
 import base64
-from bs4 import BeautifulSoup
+import html
+import re
 
 timeToDownload = 30
 
@@ -22,31 +34,441 @@ modelsIntervalOfOutputs = {"HRRR": 1,
                            "NAMNEST": 6,
                            "HRDPS": 6
                            }
+#max simultaneous downloads per host (NOMADS throttles much sooner than HPFX)
+hostConcurrencyLimits = {"nomads.ncep.noaa.gov": 4,
+                         "hpfx.collab.science.gc.ca": 10,
+                         "dd.weather.gc.ca": 6,
+                         "noaa-hrrr-bdp-pds.s3.amazonaws.com": 16,
+                         "noaa-nam-pds.s3.amazonaws.com": 16,
+                         "storage.googleapis.com": 16
+                         }
+defaultHostConcurrency = 4
+#numbers of threads downloading forecast hours of a run at the same time
+downloadWorkers = 16
+#bytes written at a time when streaming a download to disk
+downloadChunkSize = 1024 * 1024
+#how the variables are subset from the full grib2 file:
+#"filter" uses the server-side NOMADS filter_*.pl CGI, "idx" downloads only the byte ranges
+#of the requested messages listed in the .idx inventory of the static file
+modelsSubsettingMode = {"HRRR": "filter",
+                        "HRRRSH": "filter",
+                        "NAMNEST": "filter"
+                        }
+#url of the full (static) grib2 files per server, used by the idx subsetting mode
+staticUrlTemplates = {"NOMADS": {"HRRR": "https://nomads.ncep.noaa.gov/pub/data/nccf/com/hrrr/prod/hrrr.{date}/conus/hrrr.t{run}z.wrfsfcf{forecast2}.grib2",
+                                 "HRRRSH": "https://nomads.ncep.noaa.gov/pub/data/nccf/com/hrrr/prod/hrrr.{date}/conus/hrrr.t{run}z.wrfsubhf{forecast2}.grib2",
+                                 "NAMNEST": "https://nomads.ncep.noaa.gov/pub/data/nccf/com/nam/prod/nam.{date}/nam.t{run}z.conusnest.hiresf{forecast2}.tm00.grib2"
+                                 },
+                      "AWS": {"HRRR": "https://noaa-hrrr-bdp-pds.s3.amazonaws.com/hrrr.{date}/conus/hrrr.t{run}z.wrfsfcf{forecast2}.grib2",
+                              "HRRRSH": "https://noaa-hrrr-bdp-pds.s3.amazonaws.com/hrrr.{date}/conus/hrrr.t{run}z.wrfsubhf{forecast2}.grib2",
+                              "NAMNEST": "https://noaa-nam-pds.s3.amazonaws.com/nam.{date}/nam.t{run}z.conusnest.hiresf{forecast2}.tm00.grib2"
+                              },
+                      "GCP": {"HRRR": "https://storage.googleapis.com/high-resolution-rapid-refresh/hrrr.{date}/conus/hrrr.t{run}z.wrfsfcf{forecast2}.grib2",
+                              "HRRRSH": "https://storage.googleapis.com/high-resolution-rapid-refresh/hrrr.{date}/conus/hrrr.t{run}z.wrfsubhf{forecast2}.grib2"
+                              }
+                      }
+#sources of each model in order of preference. The downloads go to the best one according to the
+#measured throughput and error rate (see selectMirror) and fail over to the others.
+#NOMADS uses the mode of modelsSubsettingMode, the servers of staticUrlTemplates the idx mode
+#and the others the files of linkGenerator.
+modelMirrors = {"HRRR": ["NOMADS", "AWS", "GCP"],
+                "HRRRSH": ["NOMADS", "AWS", "GCP"],
+                "NAMNEST": ["NOMADS", "AWS"],
+                "HRDPS": ["HPFX", "MSC"]
+                }
+#throughput (bytes/s) assumed for a mirror not measured yet
+unmeasuredMirrorThroughput = 5 * 1024 ** 2
+#weight of the last download in the moving averages of throughput and error rate of a mirror
+mirrorStatsSmoothing = 0.3
+#seconds a mirror is left aside after rate limiting us (429/503) without a Retry-After
+mirrorCooldown = 300
+#download metrics snapshots (see writeMetrics), the .prom file can be read by the node_exporter textfile collector
+metricsJSONFile = "download_metrics.json"
+metricsPrometheusFile = "download_metrics.prom"
+#numbers of last fetches kept as is in the metrics snapshot
+metricsRecentFetches = 200
+
+#seconds between two availability probes (HEAD requests) of a model file
+availabilityProbeInterval = 10
+#minutes before the expected publication of a run at which probing starts
+availabilityProbeMargin = 5
+#max minutes to wait for a forecast hour to be published before giving up the run
+maxWaitForForecastHour = 90
+#variables probed for models published as one file per variable
+availabilityProbeVariables = {"HRDPS": {"TMP": ["AGL-2m"]}}
+#observed publication latencies in minutes (from run time to first file available) per model
+publicationLatencyFile = "model_latency.json"
+publicationLatencyHistory = 20
+#the expected latency is the quickest of the last observations, so it follows the model when it gets slower
+publicationLatencyWindow = 5
+
+#retries of a failed download in the concurrent engine, waiting
+#min(maxDelay, baseDelay * 2**try) seconds (with jitter) before each one.
+#The default policy is overridden by the host then by the model entries.
+defaultRetryPolicy = {"maxRetries": 30,
+                      "baseDelay": 5,
+                      "maxDelay": 120,
+                      #minutes after the first try after which the download is given up
+                      "giveUpAfter": 30,
+                      #http status that will not get better by retrying
+                      "giveUpOnStatus": [400, 401]
+                      }
+hostRetryPolicies = {"nomads.ncep.noaa.gov": {"baseDelay": 10, "maxDelay": 300}
+                     }
+modelRetryPolicies = {"HRRRSH": {"giveUpAfter": 20}
+                      }
+
+#local cache of the downloaded grib2 files, outside of downloads/ which is cleaned at each run,
+#so restarts and reprocessing don't download again (least recently used entries are evicted)
+useGribCache = True
+gribCacheDir = "./gribcache/"
+gribCacheMaxSize = 20 * 1024 ** 3
+
+_hostSemaphores = {}
+_hostSemaphoresLock = threading.Lock()
+
+def hostSemaphore(url):
+    """
+    returns the semaphore limiting simultaneous downloads on the host of url
+    (shared by every thread of the program)
+    """
+    host = urllib.parse.urlsplit(url).hostname
+    with _hostSemaphoresLock:
+        if host not in _hostSemaphores:
+            _hostSemaphores[host] = threading.BoundedSemaphore(hostConcurrencyLimits.get(host, defaultHostConcurrency))
+        return _hostSemaphores[host]
+
+_fetchTrace = threading.local()
+
+@contextmanager
+def traceFetch():
+    """
+    Traces the http requests of the current thread during the block: time to first byte
+    of the first request, bytes read, last http status and numbers of requests.
+    Yields the trace dict, filled by HTTPSession and PooledResponse.
+    """
+    trace = {"start": monotonic(), "ttfb": None, "bytes": 0, "status": None, "requests": 0}
+    _fetchTrace.current = trace
+    try:
+        yield trace
+    finally:
+        _fetchTrace.current = None
+
+def currentFetchTrace():
+    return getattr(_fetchTrace, "current", None)
+
+class HTTPStatusError(Exception):
+    """
+    Raised when a server answers with an http error status (>= 400).
+    """
+    def __init__(self, status, reason, url, headers=None):
+        super().__init__(f"HTTP Error {status}: {reason} ({url})")
+        self.status = status
+        self.reason = reason
+        self.url = url
+        self.headers = headers
+
+class PooledResponse:
+    """
+    http response of a HTTPSession request.
+
+    Reads like a file (read(size)) and gives back its keep-alive connection to the
+    session pool when closed, if the body was fully read.
+    """
+    #left over bytes read to be able to reuse a connection when a response is closed early
+    maxDrainSize = 64 * 1024
+
+    def __init__(self, session, key, connection, response, url):
+        self._session = session
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, size=-1):
+        if (size == None or size < 0):
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+        trace = currentFetchTrace()
+        if (trace != None):
+            trace["bytes"] += len(data)
+        return data
+
+    def close(self):
+        if (self._connection == None):
+            return
+        try:
+            if (not self._response.isclosed() and self._response.length != None
+                    and self._response.length <= self.maxDrainSize):
+                self._response.read()
+        except (http.client.HTTPException, OSError):
+            pass
+        if (self._response.isclosed() and not self._response.will_close):
+            self._session._releaseConnection(self._key, self._connection)
+        else:
+            self._response.close()
+            self._connection.close()
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class HTTPSession:
+    """
+    Shared keep-alive http(s) connection pool used by every fetch of this module.
+
+    Idle connections are kept per (scheme, host, port) and reused by the next request
+    on the same host, saving the TCP/TLS handshake. The Basic authorization header
+    is encoded once per credentials. Counters are kept in `stats`:
+    requests, connectionsCreated, connectionsReused and connectionsDiscarded.
+
+    Parameters:
+    - timeout : float
+        socket timeout in seconds
+    - maxIdlePerHost : int
+        max idle connections kept per host, defaults to the host entry in `hostConcurrencyLimits`
+    """
+    def __init__(self, timeout=60, maxIdlePerHost=None):
+        self.timeout = timeout
+        self.maxIdlePerHost = maxIdlePerHost
+        self._pools = {}
+        self._credentials = {}
+        self._lock = threading.Lock()
+        self._sslContext = ssl.create_default_context()
+        self.stats = {"requests": 0,
+                      "connectionsCreated": 0,
+                      "connectionsReused": 0,
+                      "connectionsDiscarded": 0
+                      }
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+    def getStats(self):
+        """
+        returns a copy of the connection counters
+        """
+        with self._lock:
+            return dict(self.stats)
+
+    def _authorization(self, username, password):
+        with self._lock:
+            if (username, password) not in self._credentials:
+                credentials = f"{username}:{password}"
+                encoded_credentials = base64.b64encode(credentials.encode()).decode()
+                self._credentials[(username, password)] = f"Basic {encoded_credentials}"
+            return self._credentials[(username, password)]
+
+    def _getConnection(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                self.stats["connectionsReused"] += 1
+                return pool.pop(), True
+            self.stats["connectionsCreated"] += 1
+        return self._newConnection(key), False
+
+    def _newConnection(self, key):
+        scheme, host, port = key
+        if (scheme == "https"):
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self._sslContext)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _releaseConnection(self, key, connection):
+        maxIdle = self.maxIdlePerHost or hostConcurrencyLimits.get(key[1], defaultHostConcurrency)
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if (len(pool) < maxIdle):
+                pool.append(connection)
+                return
+            self.stats["connectionsDiscarded"] += 1
+        connection.close()
+
+    def request(self, url, method="GET", headers=None, username=None, password=None, maxRedirects=5):
+        """
+        Sends a request on a pooled connection and returns a PooledResponse (to use with `with`).
+
+        Redirections are followed and error status (>= 400) raise HTTPStatusError.
+        Authentication is used only if both username and password are provided.
+        """
+        for redirect in range(maxRedirects + 1):
+            splitUrl = urllib.parse.urlsplit(url)
+            key = (splitUrl.scheme, splitUrl.hostname, splitUrl.port or (443 if splitUrl.scheme == "https" else 80))
+            path = splitUrl.path or "/"
+            if splitUrl.query:
+                path += "?" + splitUrl.query
+
+            requestHeaders = dict(headers or {})
+            if username and password:
+                requestHeaders["Authorization"] = self._authorization(username, password)
+
+            self._count("requests")
+            connection, reused = self._getConnection(key)
+            try:
+                connection.request(method, path, headers=requestHeaders)
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+                #an idle keep-alive connection may have been closed by the server, try on a new one
+                self._count("connectionsCreated")
+                connection = self._newConnection(key)
+                try:
+                    connection.request(method, path, headers=requestHeaders)
+                    response = connection.getresponse()
+                except BaseException:
+                    connection.close()
+                    raise
+
+            trace = currentFetchTrace()
+            if (trace != None):
+                if (trace["ttfb"] == None):
+                    trace["ttfb"] = monotonic() - trace["start"]
+                trace["status"] = response.status
+                trace["requests"] += 1
+
+            pooledResponse = PooledResponse(self, key, connection, response, url)
+            if (response.status in (301, 302, 303, 307, 308) and response.getheader("Location")):
+                pooledResponse.close()
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            if (response.status >= 400):
+                pooledResponse.close()
+                raise HTTPStatusError(response.status, response.reason, url, response.headers)
+            return pooledResponse
+        raise HTTPStatusError(response.status, "too many redirections", url, response.headers)
+
+#shared by every download and listing (and thread) of the program
+session = HTTPSession()
+
+_hrefPattern = re.compile(rb"""href\s*=\s*["']([^"']*)["']""", re.IGNORECASE)
+
+class LinkExtractor:
+    """
+    Streaming extractor of the href links of an html page, fed chunk by chunk
+    so the page never has to be held or parsed as a whole.
+    Links starting with "?" (column sorting of directory listings) are skipped.
+    """
+    #longest tail of a chunk kept in case a link is cut between two chunks
+    maxCarry = 1024
+
+    def __init__(self):
+        self.links = []
+        self._carry = b""
+
+    def feed(self, chunk):
+        buffer = self._carry + chunk
+        lastEnd = 0
+        for match in _hrefPattern.finditer(buffer):
+            link = html.unescape(match.group(1).decode(errors="replace"))
+            if not link.startswith("?"):
+                self.links.append(link)
+            lastEnd = match.end()
+        self._carry = buffer[max(lastEnd, len(buffer) - self.maxCarry):]
 
 def listRemoteFiles(url, username=None, password=None):
     """
     list files of remote HTML/http directory
     """
-    request = urllib.request.Request(url)
+    extractor = LinkExtractor()
+    with session.request(url, username=username, password=password) as response:
+        for chunk in iter(lambda: response.read(downloadChunkSize), b""):
+            extractor.feed(chunk)
+    return extractor.links
 
-    # Use authentication only if both username and password are provided
-    if username and password:
-        credentials = f"{username}:{password}"
-        encoded_credentials = base64.b64encode(credentials.encode()).decode()
-        request.add_header("Authorization", f"Basic {encoded_credentials}")
+#bytes before the end of the previous listing requested again when only the tail of a listing is fetched
+listingTailOverlap = 4096
+maxListingCacheEntries = 256
+#last listing per url: {"files", "etag", "lastModified", "length", "acceptRanges"}
+_listingCache = {}
+_listingCacheLock = threading.Lock()
 
-    with urllib.request.urlopen(request) as response:
-        html = response.read().decode()
+def listRemoteFilesConditional(url, username=None, password=None):
+    """
+    list files of remote HTML/http directory, polling it as cheaply as possible.
 
-    soup = BeautifulSoup(html, 'html.parser')
-    files = [a['href'] for a in soup.find_all('a', href=True) if not a['href'].startswith('?')]
-    
-    return files
+    The last listing of each url is kept. The next requests are conditional (If-None-Match /
+    If-Modified-Since) so an unchanged directory costs an empty 304 answer. If the server accepts
+    byte ranges, only the tail of the listing (from a bit before the end of the previous one) is
+    requested and parsed, the new links being appended to the kept ones. When the tail doesn't
+    overlap the previous listing (e.g. a file was removed), the whole listing is requested again.
+    """
+    with _listingCacheLock:
+        cached = _listingCache.get(url)
+
+    headers = {}
+    tailStart = None
+    if cached:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["lastModified"]:
+            headers["If-Modified-Since"] = cached["lastModified"]
+        if (cached["acceptRanges"] and cached["length"] > listingTailOverlap):
+            tailStart = cached["length"] - listingTailOverlap
+            headers["Range"] = f"bytes={tailStart}-"
+
+    extractor = LinkExtractor()
+    try:
+        response = session.request(url, headers=headers, username=username, password=password)
+    except HTTPStatusError as e:
+        if (e.status != 416 or tailStart == None):
+            raise
+        #the listing got shorter than the previous one, request it entirely
+        with _listingCacheLock:
+            _listingCache.pop(url, None)
+        return listRemoteFilesConditional(url, username, password)
+    with response:
+        if (response.status == 304):
+            return list(cached["files"])
+        length = 0
+        for chunk in iter(lambda: response.read(downloadChunkSize), b""):
+            extractor.feed(chunk)
+            length += len(chunk)
+        status = response.status
+        responseHeaders = response.headers
+
+    files = extractor.links
+    if (status == 206):
+        contentRange = responseHeaders.get("Content-Range", "")
+        length = int(contentRange.split("/")[-1]) if contentRange.split("/")[-1].isdigit() else tailStart + length
+        knownFiles = set(cached["files"])
+        overlap = [file for file in files if file in knownFiles]
+        if not overlap:
+            #the listing changed before the tail, request it entirely
+            with _listingCacheLock:
+                _listingCache.pop(url, None)
+            return listRemoteFilesConditional(url, username, password)
+        files = cached["files"] + [file for file in files if file not in knownFiles]
+
+    with _listingCacheLock:
+        #keep the most recently polled urls last and forget the old ones (e.g. listings of the previous days)
+        _listingCache.pop(url, None)
+        while (len(_listingCache) >= maxListingCacheEntries):
+            _listingCache.pop(next(iter(_listingCache)))
+        _listingCache[url] = {"files": files,
+                              "etag": responseHeaders.get("ETag"),
+                              "lastModified": responseHeaders.get("Last-Modified"),
+                              "length": length,
+                              "acceptRanges": responseHeaders.get("Accept-Ranges", "").lower() == "bytes" or status == 206
+                              }
+    return list(files)
 
 def isNewRadarFile(server, radarID, lastFile=None, username=None, password=None):
     """
     lastFile = last filename to be downloaded (Leave None for getting lastFile)
     server
+
+    The radar directory is polled with listRemoteFilesConditional so the many radars
+    polled every few seconds cost (mostly) empty answers.
     """
     if not (username and password):
         username, password = secret.username, secret.password
@@ -56,12 +478,12 @@ def isNewRadarFile(server, radarID, lastFile=None, username=None, password=None)
     if (server=="HPFX"):
         serverName = "hpfx.collab.science.gc.ca"
         formatted_date = utc_now.strftime('%Y%m%d')
-        url=f"http://{serverName}/{formatted_date}/radar/volume-scans/{radarID}"
+        url=f"http://{serverName}/{formatted_date}/radar/volume-scans/{radarID}/"
 
     if (lastFile==None):
-        return True, listRemoteFiles(url,username,password)[-1]
+        return True, listRemoteFilesConditional(url,username,password)[-1]
     else:
-        lastFileNow = listRemoteFiles(url,username,password)[-1]
+        lastFileNow = listRemoteFilesConditional(url,username,password)[-1]
         if (lastFileNow!=lastFile):
             return True, lastFileNow
         else:
@@ -120,6 +542,628 @@ def isItTimeToDownload(model):
         return False, time_before_next_run, current_time.strftime("%Y%m%d")
 
 
+def retryPolicy(model, link):
+    """
+    retry policy of a download: defaultRetryPolicy updated by the host then the model entries
+    """
+    policy = dict(defaultRetryPolicy)
+    policy.update(hostRetryPolicies.get(urllib.parse.urlsplit(link).hostname, {}))
+    policy.update(modelRetryPolicies.get(model, {}))
+    return policy
+
+def backoffDelay(attempt, policy):
+    """
+    seconds to wait before retrying after the try number `attempt` (starting at 0):
+    exponential backoff capped at maxDelay, with jitter so the retries of a run are spread out
+    """
+    delay = min(policy["maxDelay"], policy["baseDelay"] * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+class RetryScheduler:
+    """
+    Timed queue calling functions after a delay from a single background thread.
+
+    A failed download is parked here until its retry is due, instead of sleeping in
+    a download thread, so the threads stay free for the other forecast hours and models.
+    The scheduled functions must be quick (e.g. submitting to an executor).
+    """
+    def __init__(self):
+        self._queue = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, function, *args):
+        with self._condition:
+            heapq.heappush(self._queue, (monotonic() + delay, self._counter, function, args))
+            self._counter += 1
+            if (self._thread == None):
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return len(self._queue)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not (self._queue and self._queue[0][0] <= monotonic()):
+                    self._condition.wait(self._queue[0][0] - monotonic() if self._queue else None)
+                _, _, function, args = heapq.heappop(self._queue)
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"scheduled retry failed: {e}")
+
+#shared by every concurrent download of the program
+retryScheduler = RetryScheduler()
+
+class MirrorStats:
+    """
+    Moving averages of the throughput and error rate of each mirror (server of modelMirrors),
+    used by selectMirror to send the downloads to the best source.
+    A mirror answering 429 or 503 is left aside until the end of its cooldown
+    (Retry-After header or `mirrorCooldown` seconds).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mirrors = {}
+
+    def _entry(self, server):
+        return self._mirrors.setdefault(server, {"throughput": None,
+                                                 "errorRate": 0.0,
+                                                 "cooldownUntil": 0.0,
+                                                 "successes": 0,
+                                                 "failures": 0
+                                                 })
+
+    def recordSuccess(self, server, size, duration):
+        with self._lock:
+            entry = self._entry(server)
+            throughput = size / max(duration, 1e-3)
+            if (entry["throughput"] == None):
+                entry["throughput"] = throughput
+            else:
+                entry["throughput"] += mirrorStatsSmoothing * (throughput - entry["throughput"])
+            entry["errorRate"] *= 1 - mirrorStatsSmoothing
+            entry["successes"] += 1
+
+    def recordFailure(self, server, error):
+        with self._lock:
+            entry = self._entry(server)
+            entry["errorRate"] += mirrorStatsSmoothing * (1 - entry["errorRate"])
+            entry["failures"] += 1
+            if (getattr(error, "status", None) in (429, 503)):
+                retryAfter = (error.headers or {}).get("Retry-After", "")
+                cooldown = int(retryAfter) if retryAfter.isdigit() else mirrorCooldown
+                entry["cooldownUntil"] = monotonic() + cooldown
+                print(f"{server} is rate limiting, left aside for {cooldown} s")
+
+    def isCoolingDown(self, server):
+        with self._lock:
+            return self._entry(server)["cooldownUntil"] > monotonic()
+
+    def score(self, server, preference=0):
+        """
+        expected useful throughput of a mirror, slightly lowered for the later mirrors of the registry
+        """
+        with self._lock:
+            entry = self._entry(server)
+            throughput = unmeasuredMirrorThroughput if entry["throughput"] == None else entry["throughput"]
+            return throughput * (1 - entry["errorRate"]) * 0.9 ** preference
+
+    def getStats(self):
+        with self._lock:
+            return {server: dict(entry) for server, entry in self._mirrors.items()}
+
+#shared by every download of the program
+mirrorStats = MirrorStats()
+
+def orderedMirrors(model, exclude=()):
+    """
+    mirrors of a model from the best to the worst, the ones rate limiting us last
+    """
+    candidates = [server for server in modelMirrors[model] if server not in exclude]
+    return sorted(candidates, key=lambda server: (mirrorStats.isCoolingDown(server),
+                                                  -mirrorStats.score(server, modelMirrors[model].index(server))))
+
+def selectMirror(model, exclude=()):
+    """
+    best mirror of a model not in exclude (not rate limiting us), None if there is none
+    """
+    for server in orderedMirrors(model, exclude):
+        if not mirrorStats.isCoolingDown(server):
+            return server
+    return None
+
+def mirrorMode(model, server):
+    """
+    how a model is downloaded from a mirror: "filter", "idx" or "files" (see modelMirrors)
+    """
+    if (server == "NOMADS"):
+        return modelsSubsettingMode.get(model, "filter")
+    if (model in staticUrlTemplates.get(server, {})):
+        return "idx"
+    return "files"
+
+def mirrorJobs(model, run, forecastTime, variables, current_time, server, preOutputFile, filenames):
+    """
+    Single try download jobs (function and arguments) of a forecast hour from a mirror.
+
+    filenames are the output names of the files of the default server, so a forecast hour
+    gives the same files whatever the mirror it is downloaded from.
+    """
+    if (mirrorMode(model, server) == "idx"):
+        gribLink = staticLinkGenerator(model, run, forecastTime, current_time, server)
+        return [(downloadIdxSubsetOnce, gribLink, preOutputFile, variables, filenames[0])]
+    return [(downloadOnce, link, preOutputFile) for link in linkGenerator(model, run, forecastTime, variables, current_time, server=server)]
+
+class FetchMetrics:
+    """
+    Metrics of every download (fetch of one file, all its http requests included):
+    bytes, time to first byte, duration, throughput, retry count, http status and server.
+
+    The last `metricsRecentFetches` fetches are kept as is and all of them are aggregated
+    per (model, run, host). snapshot() gives them as a JSON-able dict and toPrometheus()
+    in the Prometheus text exposition format.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recent = collections.deque(maxlen=metricsRecentFetches)
+        self._aggregates = {}
+
+    def record(self, model, run, link, server, trace, duration, retries, error=None):
+        model, run = model or "", run or ""
+        host = urllib.parse.urlsplit(link).hostname
+        status = getattr(error, "status", None) or trace["status"] or ("error" if error else None)
+        fetch = {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                 "model": model,
+                 "run": run,
+                 "host": host,
+                 "server": server,
+                 "link": link,
+                 "status": status,
+                 "success": error == None,
+                 "bytes": trace["bytes"],
+                 "requests": trace["requests"],
+                 "ttfb": trace["ttfb"],
+                 "duration": duration,
+                 "throughput": trace["bytes"] / duration if duration > 0 else None,
+                 "retries": retries,
+                 "error": str(error) if error else None
+                 }
+        with self._lock:
+            self._recent.append(fetch)
+            aggregate = self._aggregates.setdefault((model, run, host), {"model": model,
+                                                                         "run": run,
+                                                                         "host": host,
+                                                                         "fetches": 0,
+                                                                         "failures": 0,
+                                                                         "retries": 0,
+                                                                         "bytes": 0,
+                                                                         "durationSum": 0.0,
+                                                                         "ttfbSum": 0.0,
+                                                                         "ttfbMax": 0.0,
+                                                                         "status": {}
+                                                                         })
+            aggregate["fetches"] += 1
+            aggregate["failures"] += error != None
+            aggregate["retries"] += retries if error == None else 0
+            aggregate["bytes"] += trace["bytes"]
+            aggregate["durationSum"] += duration
+            aggregate["ttfbSum"] += trace["ttfb"] or 0
+            aggregate["ttfbMax"] = max(aggregate["ttfbMax"], trace["ttfb"] or 0)
+            aggregate["status"][str(status)] = aggregate["status"].get(str(status), 0) + 1
+
+    def snapshot(self):
+        """
+        returns the recent fetches and the aggregates per (model, run, host) with their mean throughput
+        """
+        with self._lock:
+            aggregates = []
+            for aggregate in self._aggregates.values():
+                aggregate = dict(aggregate, status=dict(aggregate["status"]))
+                aggregate["throughput"] = aggregate["bytes"] / aggregate["durationSum"] if aggregate["durationSum"] > 0 else None
+                aggregates.append(aggregate)
+            return {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                    "aggregates": aggregates,
+                    "recentFetches": list(self._recent),
+                    "connectionPool": session.getStats(),
+                    "gribCache": gribCache.getStats(),
+                    "mirrors": mirrorStats.getStats()
+                    }
+
+    def toPrometheus(self):
+        """
+        returns the aggregates as Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        metrics = [("wepx_download_fetches_total", "counter", "Downloads done", lambda a: a["fetches"]),
+                   ("wepx_download_failures_total", "counter", "Downloads failed", lambda a: a["failures"]),
+                   ("wepx_download_retries_total", "counter", "Retries before successful downloads", lambda a: a["retries"]),
+                   ("wepx_download_bytes_total", "counter", "Bytes downloaded", lambda a: a["bytes"]),
+                   ("wepx_download_duration_seconds_total", "counter", "Time spent downloading", lambda a: a["durationSum"]),
+                   ("wepx_download_ttfb_seconds_total", "counter", "Sum of the times to first byte", lambda a: a["ttfbSum"]),
+                   ("wepx_download_ttfb_seconds_max", "gauge", "Longest time to first byte", lambda a: a["ttfbMax"]),
+                   ("wepx_download_throughput_bytes_per_second", "gauge", "Mean download throughput", lambda a: a["throughput"] or 0)
+                   ]
+        lines = []
+        for name, metricType, description, value in metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metricType}")
+            for aggregate in snapshot["aggregates"]:
+                lines.append(f'{name}{{model="{aggregate["model"]}",run="{aggregate["run"]}",host="{aggregate["host"]}"}} {value(aggregate)}')
+        lines.append("# HELP wepx_download_responses_total Downloads by last http status")
+        lines.append("# TYPE wepx_download_responses_total counter")
+        for aggregate in snapshot["aggregates"]:
+            for status, count in aggregate["status"].items():
+                lines.append(f'wepx_download_responses_total{{model="{aggregate["model"]}",run="{aggregate["run"]}",host="{aggregate["host"]}",status="{status}"}} {count}')
+        lines.append("# HELP wepx_connection_pool_total Connection pool counters")
+        lines.append("# TYPE wepx_connection_pool_total counter")
+        for counter, count in snapshot["connectionPool"].items():
+            lines.append(f'wepx_connection_pool_total{{counter="{counter}"}} {count}')
+        lines.append("# HELP wepx_grib_cache_total GRIB cache counters")
+        lines.append("# TYPE wepx_grib_cache_total counter")
+        for counter, count in snapshot["gribCache"].items():
+            lines.append(f'wepx_grib_cache_total{{counter="{counter}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+#shared by every download of the program
+fetchMetrics = FetchMetrics()
+
+def writeMetrics(jsonFile=None, prometheusFile=None):
+    """
+    writes (atomically) the download metrics snapshot to `metricsJSONFile` and `metricsPrometheusFile`
+    """
+    with atomicFile(jsonFile or metricsJSONFile) as f:
+        f.write(json.dumps(fetchMetrics.snapshot(), indent=4).encode())
+    with atomicFile(prometheusFile or metricsPrometheusFile) as f:
+        f.write(fetchMetrics.toPrometheus().encode())
+
+def instrumentedFetch(model, run, server, retries, function, *args):
+    """
+    runs a single try download job (function and arguments, the link first) and records
+    its metrics in fetchMetrics and its throughput or failure in mirrorStats (if server is given)
+    """
+    link = args[0]
+    with traceFetch() as trace:
+        try:
+            filepaths = function(*args)
+        except Exception as e:
+            duration = monotonic() - trace["start"]
+            if (server != None):
+                mirrorStats.recordFailure(server, e)
+            fetchMetrics.record(model, run, link, server, trace, duration, retries, e)
+            raise
+        duration = monotonic() - trace["start"]
+    if (server != None):
+        mirrorStats.recordSuccess(server, trace["bytes"], duration)
+    fetchMetrics.record(model, run, link, server, trace, duration, retries)
+    return filepaths
+
+def linkOrCopy(source, destination):
+    """
+    hard links source to destination (copies it if linking is not possible), replacing destination
+    """
+    tempPath = f"{destination}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        os.link(source, tempPath)
+    except OSError:
+        shutil.copyfile(source, tempPath)
+    os.replace(tempPath, destination)
+
+def fileChecksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(downloadChunkSize), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+class GribCache:
+    """
+    Content-addressed local cache of downloaded grib2 files.
+
+    An entry holds the files of one forecast hour and is keyed by a hash of
+    (model, run date, run, forecast hour, variable set). Its files are checked
+    (size and sha256) before being served, a corrupted entry is dropped. The least
+    recently used entries are evicted when the cache is over maxSize bytes.
+    The index is saved in `index.json` so the cache survives restarts.
+    Counters are kept in `stats`: hits, misses, stores, evictions and corrupted.
+
+    Parameters:
+    - directory : str
+        folder of the cache
+    - maxSize : int
+        max size of the cached files in bytes
+    """
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        self._index = None
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "corrupted": 0}
+
+    def getStats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    @staticmethod
+    def key(model, date, run, forecastTime, variables):
+        identity = json.dumps([model, date, str(run).zfill(2), str(forecastTime).zfill(2),
+                               {variable: sorted(variables[variable]) for variable in variables}], sort_keys=True)
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def _loadIndex(self):
+        if (self._index == None):
+            indexPath = os.path.join(self.directory, "index.json")
+            if os.path.exists(indexPath):
+                with open(indexPath, 'r') as f:
+                    self._index = json.load(f)
+            else:
+                self._index = {}
+        return self._index
+
+    def _saveIndex(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with atomicFile(os.path.join(self.directory, "index.json")) as f:
+            f.write(json.dumps(self._index).encode())
+
+    def _remove(self, key):
+        self._index.pop(key, None)
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def fetch(self, model, date, run, forecastTime, variables, preOutputFile):
+        """
+        Serves a cached forecast hour: its files are linked next to preOutputFile
+        (e.g. "./downloads/HRRR/00/total.05.") under their original names.
+
+        Returns:
+        - list: the filepaths (same as download()), None if not cached
+        """
+        key = self.key(model, date, run, forecastTime, variables)
+        with self._lock:
+            entry = self._loadIndex().get(key)
+            if (entry == None):
+                self.stats["misses"] += 1
+                return None
+
+        #files are checked and linked without holding the lock (hashing takes seconds)
+        try:
+            for name, size, checksum in entry["files"]:
+                cachedPath = os.path.join(self.directory, key, name)
+                if (os.path.getsize(cachedPath) != size or fileChecksum(cachedPath) != checksum):
+                    raise Exception(f"checksum mismatch for {cachedPath}")
+            os.makedirs(os.path.dirname(preOutputFile), exist_ok=True)
+            outputFiles = []
+            for name, size, checksum in entry["files"]:
+                outputFiles.append(os.path.join(os.path.dirname(preOutputFile), name))
+                linkOrCopy(os.path.join(self.directory, key, name), outputFiles[-1])
+        except Exception as e:
+            print(f"grib cache entry dropped: {e}")
+            with self._lock:
+                #unless it was stored again meanwhile
+                if (self._index.get(key) is entry):
+                    self._remove(key)
+                    self._saveIndex()
+                self.stats["corrupted"] += 1
+                self.stats["misses"] += 1
+            return None
+
+        with self._lock:
+            entry["lastAccess"] = datetime.now(timezone.utc).timestamp()
+            self._saveIndex()
+            self.stats["hits"] += 1
+        print(f"grib cache hit: {model} {run}z forecast {forecastTime}")
+        return outputFiles
+
+    def store(self, model, date, run, forecastTime, variables, filepaths):
+        """
+        Adds the downloaded files of a forecast hour to the cache and evicts the least
+        recently used entries if the cache gets over maxSize.
+        """
+        key = self.key(model, date, run, forecastTime, variables)
+        entryDir = os.path.join(self.directory, key)
+        #files are hashed and linked into a temporary folder without holding the lock
+        tempDir = f"{entryDir}.{os.getpid()}.{threading.get_ident()}.part"
+        shutil.rmtree(tempDir, ignore_errors=True)
+        os.makedirs(tempDir)
+        try:
+            files = []
+            for path in filepaths:
+                name = os.path.basename(path)
+                linkOrCopy(path, os.path.join(tempDir, name))
+                files.append([name, os.path.getsize(path), fileChecksum(path)])
+        except BaseException:
+            shutil.rmtree(tempDir, ignore_errors=True)
+            raise
+
+        with self._lock:
+            index = self._loadIndex()
+            self._remove(key)
+            os.replace(tempDir, entryDir)
+            index[key] = {"files": files,
+                          "size": sum(file[1] for file in files),
+                          "lastAccess": datetime.now(timezone.utc).timestamp()
+                          }
+            self.stats["stores"] += 1
+
+            totalSize = sum(entry["size"] for entry in index.values())
+            for oldKey in sorted(index, key=lambda oldKey: index[oldKey]["lastAccess"]):
+                if (totalSize <= self.maxSize or oldKey == key):
+                    break
+                totalSize -= index[oldKey]["size"]
+                self._remove(oldKey)
+                self.stats["evictions"] += 1
+            self._saveIndex()
+
+#shared by every download of the program
+gribCache = GribCache(gribCacheDir, gribCacheMaxSize)
+
+_availabilityLock = threading.Lock()
+_publicationLatencies = None
+#run datetime -> monotonic time when its first forecast hour was seen published, per model
+_detectedRuns = {}
+#runs probed at least once before being published (their latency can be learned)
+_missedRuns = set()
+#hours after which a run is dropped from _detectedRuns and _missedRuns
+detectedRunsRetention = 24
+
+def loadPublicationLatencies():
+    """
+    returns the observed publication latencies per model (loaded once from publicationLatencyFile)
+    """
+    global _publicationLatencies
+    with _availabilityLock:
+        if (_publicationLatencies == None):
+            if os.path.exists(publicationLatencyFile):
+                with open(publicationLatencyFile, 'r') as f:
+                    _publicationLatencies = json.load(f)
+            else:
+                _publicationLatencies = {}
+        return _publicationLatencies
+
+def recordPublicationLatency(model, latency):
+    """
+    Adds an observed publication latency (minutes) of model to the history and saves it.
+    Only the last `publicationLatencyHistory` observations are kept.
+    """
+    latencies = loadPublicationLatencies()
+    with _availabilityLock:
+        history = latencies.setdefault(model, [])
+        history.append(round(latency, 1))
+        del history[:-publicationLatencyHistory]
+        with atomicFile(publicationLatencyFile) as f:
+            f.write(json.dumps(latencies, indent=4).encode())
+    print(f"{model} published {latency:.1f} minutes after run time")
+
+def expectedPublicationLatency(model):
+    """
+    Expected minutes between a run time and the publication of its first file:
+    the quickest of the last `publicationLatencyWindow` observations, or `modelsLeadTime`
+    when there is no history yet.
+    """
+    history = loadPublicationLatencies().get(model)
+    if history:
+        return min(history[-publicationLatencyWindow:])
+    return modelsLeadTime[model]
+
+def probeLink(model, run, forecastTime, current_time=None, server=None):
+    """
+    link requested to know if a forecast hour is published on a mirror (defaults to the first one):
+    the .idx inventory of the static file (written once the grib2 file is complete) or
+    the file of a probe variable for one file per variable models
+    """
+    if (server == None):
+        server = modelMirrors[model][0]
+    if (model in staticUrlTemplates.get(server, {})):
+        return staticLinkGenerator(model, run, forecastTime, current_time, server) + ".idx"
+    return linkGenerator(model, run, forecastTime, availabilityProbeVariables[model], current_time, server=server)[0]
+
+def isForecastAvailable(model, run, forecastTime, current_time=None):
+    """
+    Checks with a HEAD request if a forecast hour of a run is published.
+
+    The mirrors are asked in the order of modelMirrors (the first one usually publishes first),
+    the ones rate limiting us last. If one fails, the next one is asked, but a mirror answering
+    that the file doesn't exist is trusted.
+
+    Returns:
+    - bool: True if the file is available
+    """
+    for server in sorted(modelMirrors[model], key=mirrorStats.isCoolingDown):
+        link = probeLink(model, run, forecastTime, current_time, server)
+        try:
+            with hostSemaphore(link), session.request(link, method="HEAD"):
+                return True
+        except HTTPStatusError as e:
+            if (e.status in (403, 404)):
+                return False
+            print(f"availability probe failed: {e}")
+            mirrorStats.recordFailure(server, e)
+        except (http.client.HTTPException, OSError) as e:
+            print(f"availability probe failed: {e}")
+            mirrorStats.recordFailure(server, e)
+    return False
+
+def waitForForecastHour(model, run, forecastTime, current_time=None, stopEvent=None):
+    """
+    Probes a forecast hour every `availabilityProbeInterval` seconds until it is published.
+
+    Returns:
+    - bool: True once published, False if stopEvent was set while waiting
+
+    Raises:
+    Exception: if the hour is still not published after `maxWaitForForecastHour` minutes
+    """
+    deadline = monotonic() + maxWaitForForecastHour * 60
+    while not isForecastAvailable(model, run, forecastTime, current_time):
+        if (monotonic() > deadline):
+            raise Exception(f"{model} {run}z forecast {forecastTime} not published after {maxWaitForForecastHour} minutes")
+        if (stopEvent != None):
+            if stopEvent.wait(availabilityProbeInterval):
+                return False
+        else:
+            sleep(availabilityProbeInterval)
+    return True
+
+def isRunAvailable(model):
+    """
+    Determines if the latest run of a model is published by probing its first forecast hour.
+
+    Replaces the fixed `modelsLeadTime` guess of isItTimeToDownload: probing of a run starts
+    `availabilityProbeMargin` minutes before its expected publication (learned from the previous runs,
+    see expectedPublicationLatency) and the run is downloadable as soon as its first file is published.
+    As with isItTimeToDownload, True is returned during `timeToDownload` minutes after the publication.
+
+    Parameters:
+    model : str
+        The name of the weather model to check.
+
+    Returns:
+    tuple:
+        - bool : True if it's time to download, False otherwise.
+        - int or float : The hour of the latest run or the time before the next check (in seconds).
+        - str : The date of the run in "YYYYMMDD" format.
+    """
+    current_time = datetime.now(timezone.utc)
+    interval = modelsIntervalOfOutputs[model]
+    probeStart = timedelta(minutes=expectedPublicationLatency(model) - availabilityProbeMargin)
+
+    # newest run that may already be published
+    latestRun = current_time.replace(hour=current_time.hour - current_time.hour % interval, minute=0, second=0, microsecond=0)
+    while (latestRun + probeStart > current_time):
+        latestRun -= timedelta(hours=interval)
+    runKey = (model, latestRun)
+
+    with _availabilityLock:
+        #forget the runs out of the detection window so the sets don't grow for the life of the process
+        oldestRun = current_time - timedelta(hours=detectedRunsRetention)
+        for oldKey in [key for key in _detectedRuns if key[1] < oldestRun]:
+            del _detectedRuns[oldKey]
+        _missedRuns.difference_update([key for key in _missedRuns if key[1] < oldestRun])
+        detected = _detectedRuns.get(runKey)
+    if (detected == None):
+        if not isForecastAvailable(model, str(latestRun.hour).zfill(2), 0, latestRun.strftime("%Y%m%d")):
+            with _availabilityLock:
+                _missedRuns.add(runKey)
+            return False, availabilityProbeInterval, latestRun.strftime("%Y%m%d")
+        detected = monotonic()
+        with _availabilityLock:
+            _detectedRuns[runKey] = detected
+            learn = runKey in _missedRuns
+        latency = (current_time - latestRun).total_seconds() / 60
+        # a run already published when first probed only gives an upper bound of its latency,
+        # learned only if quicker than expected so the probing starts earlier for the next runs
+        if (learn or latency < expectedPublicationLatency(model)):
+            recordPublicationLatency(model, latency)
+
+    if (monotonic() - detected < timeToDownload * 60):
+        return True, latestRun.hour, latestRun.strftime("%Y%m%d")
+    time_before_next_run = ((latestRun + timedelta(hours=interval) + probeStart) - current_time).total_seconds()
+    return False, max(time_before_next_run, availabilityProbeInterval), latestRun.strftime("%Y%m%d")
+
 def linkGenerator(model, run, forecastTime, variables, current_time=None, server=None, sharedModel=None):
     """
     Generates a download link for weather model data from the specified server, based on the model, run time, forecast time, variable, and level.
@@ -207,7 +1251,23 @@ def linkGenerator(model, run, forecastTime, variables, current_time=None, server
             raise Exception("model not implemented in current server")
     
     elif (server=="MSC"):
-        raise Exception("server not yet implemented (WIP), use HPFX instead")
+        #MSC Datamart, same tree as HPFX
+        serverURL = "https://dd.weather.gc.ca"
+        isRunNbGood(run, model)
+        if (current_time == None):
+            current_time = datetime.now(timezone.utc)
+            current_time = f"{current_time.year:04}{current_time.month:02}{current_time.day:02}"
+
+        if (model=="HRDPS"):
+            url = []
+            for variable in variables:
+                for level in variables[variable]:
+                    remoteFilename = f"{current_time}T{run}Z_MSC_HRDPS_{variable}_{level}_RLatLon0.0225_PT{str(forecastTime).zfill(3)}H.grib2"
+                    url.append(f"{serverURL}/{current_time}/WXO-DD/model_hrdps/continental/2.5km/{run}/{str(forecastTime).zfill(3)}/{remoteFilename}")
+            print (f"download link: {url}")
+            return url
+        else:
+            raise Exception("model not implemented in current server")
 
     elif (server=="HPFX"):
         serverURL = "http://hpfx.collab.science.gc.ca"
@@ -239,7 +1299,227 @@ def isRunNbGood(run, model):
         return False
     return True
 
-def download(link, filepath = None, username = None, password = None, numbersOfRetry = 30, delayBeforeTryingAgain = 35):
+@contextmanager
+def atomicFile(downloadPath):
+    """
+    Opens a temporary file next to downloadPath for writing and moves it into place with
+    os.replace when the block ends without error, so a partial file is never seen at
+    downloadPath. The temporary file is removed on failure.
+    """
+    tempPath = f"{downloadPath}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        with open(tempPath, "wb") as out_file:
+            yield out_file
+        os.replace(tempPath, downloadPath)
+    except BaseException:
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+        raise
+
+def copyResponse(response, out_file, chunkSize=None):
+    """
+    Copies an http response to an opened file by fixed-size chunks so memory use stays
+    the same whatever the size of the file, and checks the size against the Content-Length.
+
+    Returns:
+    - int: numbers of bytes written
+    """
+    expectedSize = response.headers.get("Content-Length")
+    size = 0
+    while True:
+        chunk = response.read(chunkSize or downloadChunkSize)
+        if not chunk:
+            break
+        out_file.write(chunk)
+        size += len(chunk)
+    if (expectedSize != None and size != int(expectedSize)):
+        raise Exception(f"Download truncated: received {size} of {expectedSize} bytes")
+    return size
+
+def streamToFile(response, downloadPath, chunkSize=None):
+    """
+    Writes an http response to downloadPath by fixed-size chunks.
+
+    The data is written to a temporary file and moved into place only once its size
+    matches the Content-Length (see atomicFile and copyResponse), so the converter
+    never sees a truncated file.
+
+    Parameters:
+    - response : file-like http response (with headers)
+    - downloadPath : str
+        final path of the file
+    - chunkSize : int
+        bytes read at a time, defaults to `downloadChunkSize`
+
+    Returns:
+    - int: numbers of bytes written
+    """
+    with atomicFile(downloadPath) as out_file:
+        return copyResponse(response, out_file, chunkSize)
+
+def parseIdx(text):
+    """
+    Parses a grib2 .idx inventory (wgrib2 format) into a list of messages.
+
+    Each line looks like "12:1234567:d=2025012306:REFC:entire atmosphere:1 hour fcst:"
+
+    Returns:
+    - list of dict: {"message", "start", "end", "variable", "level", "forecast"} in file order,
+      end is the last byte of the message (None for the last message of the file)
+    """
+    inventory = []
+    for line in text.splitlines():
+        fields = line.split(":")
+        if (len(fields) < 6):
+            continue
+        inventory.append({"message": fields[0],
+                          "start": int(fields[1]),
+                          "end": None,
+                          "variable": fields[3],
+                          "level": fields[4],
+                          "forecast": fields[5]
+                          })
+
+    #a message ends where the next offset starts (submessages share the offset of their message)
+    offsets = sorted({message["start"] for message in inventory})
+    nextOffset = dict(zip(offsets[:-1], offsets[1:]))
+    for message in inventory:
+        if (message["start"] in nextOffset):
+            message["end"] = nextOffset[message["start"]] - 1
+    return inventory
+
+def idxLevelName(level):
+    """
+    converts a NOMADS filter level (e.g. "lev_2_m_above_ground") to its .idx name ("2 m above ground")
+    """
+    if (level.startswith("lev_")):
+        level = level[len("lev_"):]
+    return level.replace("_", " ")
+
+def selectIdxByteRanges(inventory, variables):
+    """
+    Returns the merged (start, end) byte ranges of the messages of `inventory` matching
+    `variables` (variables as keys and list of levels as items, "all_lev" matches every level).
+    Adjacent ranges are merged so each one is a single Range request. end can be None (end of file).
+    """
+    wantedLevels = {}
+    for variable in variables:
+        if ("all_lev" in variables[variable]):
+            wantedLevels[variable] = None
+        else:
+            wantedLevels[variable] = {idxLevelName(level) for level in variables[variable]}
+
+    ranges = []
+    for message in inventory:
+        if (message["variable"] not in wantedLevels):
+            continue
+        levels = wantedLevels[message["variable"]]
+        if (levels != None and message["level"] not in levels):
+            continue
+        start, end = message["start"], message["end"]
+        if (ranges and ranges[-1][1] != None and ranges[-1][1] + 1 >= start):
+            #adjacent (or submessage of the same) message, extend the previous range
+            if (end == None or end > ranges[-1][1]):
+                ranges[-1] = (ranges[-1][0], end)
+        elif not (ranges and ranges[-1][1] == None):
+            ranges.append((start, end))
+    return ranges
+
+def streamRangesToFile(link, ranges, downloadPath, username=None, password=None, chunkSize=None):
+    """
+    Downloads the byte ranges of link with http Range requests and concatenates them
+    into downloadPath (written atomically, see atomicFile).
+
+    Returns:
+    - int: numbers of bytes written
+    """
+    size = 0
+    with atomicFile(downloadPath) as out_file:
+        for start, end in ranges:
+            byteRange = f"bytes={start}-" if end == None else f"bytes={start}-{end}"
+            with session.request(link, headers={"Range": byteRange}, username=username, password=password) as response:
+                if (response.status != 206):
+                    raise Exception(f"server does not support range requests ({response.status}): {link}")
+                size += copyResponse(response, out_file, chunkSize)
+    return size
+
+def outputFilename(link):
+    """
+    name of the downloaded file of a link (NOMADS filter script name gets a grib2 extension)
+    """
+    #skip urlParams
+    filename = (link.split("/")[-1]).split("?")[0]
+    if ("nomads" in link):
+        filename = filename.replace("pl","grib2")
+    return filename
+
+def staticLinkGenerator(model, run, forecastTime, current_time=None, server="NOMADS"):
+    """
+    Generates the link of the full (static) grib2 file of a forecast hour from `staticUrlTemplates`.
+    Its inventory is at the same link with ".idx" appended.
+    """
+    isRunNbGood(run, model)
+    if (current_time == None):
+        current_time = datetime.now(timezone.utc)
+        current_time = f"{current_time.year:04}{current_time.month:02}{current_time.day:02}"
+    try:
+        template = staticUrlTemplates[server][model]
+    except KeyError:
+        raise Exception(f"no static file link for {model} on {server}")
+    return template.format(date=current_time, run=run, forecast2=str(forecastTime).zfill(2), forecast3=str(forecastTime).zfill(3))
+
+def downloadIdxSubset(link, filepath, variables, filename=None, username=None, password=None, numbersOfRetry=30, delayBeforeTryingAgain=35):
+    """
+    Downloads only the messages of `variables` from a static grib2 file.
+
+    The .idx inventory of the file is downloaded, the matching messages (variable and level)
+    are resolved to merged byte ranges and only those are fetched with http Range requests,
+    concatenated into a single grib2 file.
+
+    Parameters:
+    - link : str
+        link of the full grib2 file (see staticLinkGenerator)
+    - filepath : str
+        prefix of the output file (e.g. "./downloads/HRRR/00/total.05.")
+    - variables: dict
+        variables as keys and their item represent a list of the height to download
+    - filename : str
+        output filename appended to filepath, defaults to the remote filename
+    
+    Returns:
+    - list: the downloaded filepath (same as download())
+    """
+    for test in range(numbersOfRetry):
+        try:
+            print(f"downloading subset try: {test}")
+            return downloadIdxSubsetOnce(link, filepath, variables, filename, username, password)
+        except Exception as e:
+            print("Download unsuccessful")
+            print(e)
+            sleep(delayBeforeTryingAgain)
+    raise Exception("Download unsucessful, numbersOfRetry reached")
+
+def downloadIdxSubsetOnce(link, filepath, variables, filename=None, username=None, password=None):
+    """
+    single try of downloadIdxSubset (no retry), raises on failure
+    """
+    if (filename == None):
+        filename = outputFilename(link)
+    downloadPath = filepath + filename
+    print(link)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with hostSemaphore(link):
+        with session.request(link + ".idx", username=username, password=password) as response:
+            inventory = parseIdx(response.read().decode())
+        ranges = selectIdxByteRanges(inventory, variables)
+        if not ranges:
+            raise Exception(f"no requested variable found in {link}.idx")
+        streamRangesToFile(link, ranges, downloadPath, username, password)
+    return [downloadPath]
+
+def download(link, filepath = None, username = None, password = None, numbersOfRetry = 30, delayBeforeTryingAgain = 35, model = None, run = None):
     
     downloadedFiles = []
 
@@ -250,32 +1530,9 @@ def download(link, filepath = None, username = None, password = None, numbersOfR
 
     for link in link:
         for test in range(numbersOfRetry):
-            #skip urlParams
-            filename = (link.split("/")[-1]).split("?")[0]
-            if ("nomads" in link):
-                filename = filename.replace("pl","grib2")
-                print(filename)
-            print("link " + link)
-            downloadPath = filepath + filename
-            
             try:
                 print(f"downloading try: {test}")
-                print(link)
-
-                request = urllib.request.Request(link)
-
-                # Use authentication only if both username and password are provided
-                if username and password:
-                    credentials = f"{username}:{password}"
-                    encoded_credentials = base64.b64encode(credentials.encode()).decode()
-                    request.add_header("Authorization", f"Basic {encoded_credentials}")
-                
-                os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                with urllib.request.urlopen(request) as response, open(downloadPath, "wb") as out_file:
-                    out_file.write(response.read())
-                f = open(downloadPath)
-                f.close()
-                downloadedFiles.append(downloadPath)
+                downloadedFiles += instrumentedFetch(model, run, None, test, downloadOnce, link, filepath, username, password)
                 break
             except Exception as e:
                 print("Download unsuccessful")
@@ -286,6 +1543,20 @@ def download(link, filepath = None, username = None, password = None, numbersOfR
             raise Exception("Download unsucessful, numbersOfRetry reached")
     return downloadedFiles
 
+def downloadOnce(link, filepath, username=None, password=None):
+    """
+    single try of download() for one link (no retry), raises on failure
+
+    Returns:
+    - list: the downloaded filepath
+    """
+    downloadPath = filepath + outputFilename(link)
+    print("link " + link)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with hostSemaphore(link), session.request(link, username=username, password=password) as response:
+        streamToFile(response, downloadPath)
+    return [downloadPath]
+
 def download_model(model, run, variables, forecastTime=None, forecastNb=None, current_time=None, sharedModel=None):
     """
     Downloads HRRR model data for a given run and forecast time.
@@ -332,9 +1603,139 @@ def download_model(model, run, variables, forecastTime=None, forecastNb=None, cu
     #in automated run:
     else:
         preOutputFile = f"./downloads/{model}/{run}/total.{forecastTime}."
+        runDate = current_time or datetime.now(timezone.utc).strftime("%Y%m%d")
         download_link = linkGenerator(model,run,forecastTime,variables,current_time,sharedModel=sharedModel)
-        return download(download_link, preOutputFile)
-        
+        if useGribCache:
+            cachedFiles = gribCache.fetch(model, runDate, run, forecastTime, variables, preOutputFile)
+            if (cachedFiles != None):
+                return cachedFiles
+        downloadedFiles = download(download_link, preOutputFile)
+        if useGribCache:
+            gribCache.store(model, runDate, run, forecastTime, variables, downloadedFiles)
+        return downloadedFiles
+
+def downloadForecastHours(model, run, variables, forecastHours, current_time=None, sharedModel=None, maxWorkers=None, waitForAvailability=True):
+    """
+    Downloads many forecast hours (and every file of each hour) of a run at the same time.
+
+    Forecast hours are queued in a thread pool in forecast order, each one as soon as it is published
+    (probed with waitForForecastHour, so no retry is burnt on a file not yet out), and the number of
+    simultaneous downloads on each host is capped by `hostConcurrencyLimits`. A failed download waits
+    for its retry in `retryScheduler` (exponential backoff with jitter, see retryPolicy) so the download
+    threads stay free meanwhile. Each download goes to the best mirror of `modelMirrors` (measured
+    throughput and error rate) and fails over to another one when it fails or rate limits us.
+    Forecast hours already in `gribCache` are served from it without any
+    request, and downloaded ones are added to it. A forecast hour is yielded as soon as all of its files
+    landed so the conversion can start while the next hours are downloading.
+
+    Parameters:
+    - model : str
+        The model name (e.g., "HRRR")
+    - run : str
+        The model run time (e.g., "00", "06", "12", or "18").
+    - variables: dict
+        variables as keys and their item represent a list of the height to download
+    - forecastHours : iterable of int
+        forecast hours to download (e.g., range(49))
+    - current_time : str
+        The current date in "YYYYMMDD" format.
+    - sharedModel : model object with server proprety
+    - maxWorkers : int
+        numbers of download threads, defaults to `downloadWorkers`
+    - waitForAvailability : bool
+        probe each forecast hour before queuing its download
+
+    Yields:
+    - tuple: (forecastTime as 2 digits str, list of downloaded filepaths) in order of completion
+    """
+    print(f"started download {model}")
+    forecastHours = [str(forecast).zfill(2) for forecast in forecastHours]
+    runDate = current_time or datetime.now(timezone.utc).strftime("%Y%m%d")
+    executor = ThreadPoolExecutor(max_workers=maxWorkers or downloadWorkers)
+    completed = queue.Queue()
+    stop = threading.Event()
+    remaining = {}
+    downloadedFiles = {}
+
+    def submitForecastHours():
+        try:
+            for forecastTime in forecastHours:
+                preOutputFile = f"./downloads/{model}/{run}/total.{forecastTime}."
+                #also sets the server of sharedModel, needed by the conversion even for cached files
+                download_link = linkGenerator(model,run,forecastTime,variables,current_time,sharedModel=sharedModel)
+                cachedFiles = gribCache.fetch(model, runDate, run, forecastTime, variables, preOutputFile) if useGribCache else None
+                if (cachedFiles != None):
+                    completed.put(((forecastTime, None), cachedFiles))
+                    continue
+                if (waitForAvailability and not waitForForecastHour(model, run, forecastTime, current_time, stop)):
+                    return
+                #the files keep the names given by the default server whatever the mirror
+                filenames = [outputFilename(link) for link in download_link]
+                hourJobs = lambda server, forecastTime=forecastTime, preOutputFile=preOutputFile, filenames=filenames: \
+                    mirrorJobs(model, run, forecastTime, variables, current_time, server, preOutputFile, filenames)
+                server = selectMirror(model) or orderedMirrors(model)[0]
+                jobsNb = len(hourJobs(server))
+                remaining[forecastTime] = jobsNb
+                downloadedFiles[forecastTime] = [None] * jobsNb
+                for index in range(jobsNb):
+                    submitAttempt((forecastTime, index), hourJobs, server, {server}, monotonic(), 0)
+        except BaseException as e:
+            completed.put((None, e))
+
+    def submitAttempt(key, hourJobs, server, triedServers, firstTry, attempt):
+        if stop.is_set():
+            return
+        job = hourJobs(server)[key[1]]
+        future = executor.submit(instrumentedFetch, model, run, server, attempt, *job)
+        future.add_done_callback(lambda future: attemptDone(key, hourJobs, server, triedServers, job, firstTry, attempt, future))
+
+    def attemptDone(key, hourJobs, server, triedServers, job, firstTry, attempt, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        policy = retryPolicy(model, job[1])
+        if (error != None and not stop.is_set()
+                and attempt + 1 < policy["maxRetries"]
+                and monotonic() - firstTry < policy["giveUpAfter"] * 60
+                and getattr(error, "status", None) not in policy["giveUpOnStatus"]):
+            #fail over right away to a mirror not tried yet, otherwise back off on the best one
+            nextServer = selectMirror(model, exclude=triedServers)
+            if (nextServer != None):
+                delay = 0
+            else:
+                nextServer = selectMirror(model) or server
+                delay = backoffDelay(attempt, policy)
+            print(f"Download unsuccessful ({error}), try {attempt + 1} on {nextServer} in {delay:.0f} s: {job[1]}")
+            #the retry waits in the scheduler, not in a download thread
+            retryScheduler.schedule(delay, submitAttempt, key, hourJobs, nextServer, triedServers | {nextServer}, firstTry, attempt + 1)
+            return
+        completed.put((key, future))
+
+    submitter = threading.Thread(target=submitForecastHours, daemon=True)
+    submitter.start()
+    try:
+        yielded = 0
+        while (yielded < len(forecastHours)):
+            key, result = completed.get()
+            if (key == None):
+                raise result
+            forecastTime, index = key
+            if (index == None):
+                #served by the grib cache
+                downloadedFiles[forecastTime] = result
+                remaining[forecastTime] = 0
+            else:
+                downloadedFiles[forecastTime][index] = result.result()[0]
+                remaining[forecastTime] -= 1
+                if (remaining[forecastTime] == 0 and useGribCache):
+                    gribCache.store(model, runDate, run, forecastTime, variables, downloadedFiles[forecastTime])
+            if (remaining[forecastTime] == 0):
+                yielded += 1
+                yield forecastTime, downloadedFiles.pop(forecastTime)
+    finally:
+        #stop probing and queued downloads if the caller stopped early or a download failed
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
  
 
 def waitForDataAvailable():
@@ -5,6 +5,7 @@ import threading
 from time import sleep
 import download
 import convert
+import derived
 import shutil
 import os
 from datetime import datetime, timedelta, timezone
@@ -26,7 +27,10 @@ vminDict = {"DPT":-80,
             "HAIL":0,
             "SBT124": 100,
             "BRTMP": 100,
-            "GUST": 0
+            "GUST": 0,
+            "WIND": 0,
+            "DEPR": -10,
+            "CAPESHEAR": 0
             }
 vmaxDict = {"DPT":80,
             "TMP":80,
@@ -37,9 +41,32 @@ vmaxDict = {"DPT":80,
             "HAIL":1,
             "SBT124": 400,
             "BRTMP": 400,
-            "GUST": 115
+            "GUST": 115,
+            "WIND": 115,
+            "DEPR": 80,
+            "CAPESHEAR": 1000000
             }
 
+#precision of the encoded values by variable: bits (8 grayscale, 16 in R and G, 24 in R, G and B)
+#and step between two values (value = vmin + code * step), others are 24-bit over vmin-vmax
+precisionDict = {"REFC": {"bits": 8, "step": 0.5},
+                 "HAIL": {"bits": 16, "step": 0.0001},
+                 "RETOP": {"bits": 16, "step": 1},
+                 "WIND": {"bits": 16, "step": 0.01},
+                 "DEPR": {"bits": 16, "step": 0.01},
+                 "CAPESHEAR": {"bits": 16, "step": 20}
+                 }
+
+#lossless WebP encoder settings by variable (method 0-6, quality 0-100), others use convert.webp_method/webp_quality
+#mostly empty fields compress much better with the slowest method
+webpSettingsDict = {"REFC": {"method": 6},
+                    "RETOP": {"method": 6},
+                    "HAIL": {"method": 6}
+                    }
+
+#slow-moving variables encoded as deltas against the previous forecast hour (see convert.deltaEncode)
+deltaEncodedVariables = ["TMP", "DPT", "CAPE"]
+
 #variables to download for each models and surface level
 variablesHRRR = {"RETOP":["lev_cloud_top"], 
                  "CAPE":["lev_surface"],
@@ -73,11 +100,29 @@ variablesHRDPS = {"CAPE":["Sfc"],
                   "GUST":["AGL-10m"]
                  }
 
+#derived products computed for each models and their level (see derived.py),
+#their inputs are downloaded with the variables but only converted if listed there
+derivedHRRR = {"WIND": ["lev_10_m_above_ground"],
+               "DEPR": ["lev_2_m_above_ground"],
+               "CAPESHEAR": ["lev_surface"]
+               }
+derivedHRRRSH = {"WIND": ["lev_10_m_above_ground"]
+                 }
+derivedNAMNEST = {"WIND": ["lev_10_m_above_ground"],
+                  "DEPR": ["lev_2_m_above_ground"]
+                  }
+derivedHRDPS = {"WIND": ["AGL-10m"],
+                "DEPR": ["AGL-2m"]
+                }
+
 #extent of full output
 #extent=[-143.261719,13.410994,-39.023438,60.930432]
 
 download.timeToDownload = 15
 convert.export_json = True
+#bands converted in the calling thread: the process pool is opt-in until benchmark.benchmarkConversionWorkers
+#shows it scales on a multi-core machine (see README)
+convert.conversion_workers = 0
 
 
 # Dictionary to keep track of running models
@@ -92,12 +137,20 @@ class Model:
         # Fallback for undefined attributes
         raise BaseException(name + "is not defined")
 
+def renderedFilesList(renderedFiles):
+    """
+    list of the files rendered by convert.convertFromNCToPNG (which returns a single file as a str)
+    """
+    if (isinstance(renderedFiles, str)):
+        return [renderedFiles]
+    return list(renderedFiles)
+
 def processModel(modelName, timeOutput,current_time):
     """
     Downloads weather model data for a specified model and time, and converts the downloaded files to PNG and WEBP formats.
 
-    The function first determines the number of forecast hours to download based on the model and run time. It then iterates
-    through each forecast hour, downloads the corresponding data, converts the data from GRIB to PNG, and finally converts 
+    The function first determines the number of forecast hours to download based on the model and run time. It then downloads
+    the forecast hours concurrently and, as soon as a forecast hour has landed, converts the data from GRIB to PNG, and finally converts 
     the PNG to WEBP format for web use.
 
     Parameters:
@@ -110,14 +163,15 @@ def processModel(modelName, timeOutput,current_time):
     
     Process:
     - Determine the number of forecast hours based on the model and run time.
-    - Download the GRIB2 data for each forecast hour.
-    - Convert each GRIB2 file to PNG using a variable-specific range (vmin, vmax).
-    - Convert the PNG files to WEBP format for optimized web use.
+    - Download the GRIB2 data of all forecast hours concurrently (see download.downloadForecastHours).
+    - Convert each GRIB2 file using a variable-specific range (vmin, vmax), directly to lossless WEBP
+      (or to PNG files then converted to WEBP if convert.output_format is "png").
     """
     try:
         model = Model()
         model.name = modelName
         model.variables = globals()["variables" + model.name]
+        model.derived = globals().get("derived" + model.name, {})
 
         print(current_time)
         model.run = str(timeOutput).zfill(2)
@@ -148,28 +202,52 @@ def processModel(modelName, timeOutput,current_time):
         except Exception as e:
             print(e)
 
-        for forecast in range(model.forecastNb+1):
-            os.system("title Running " + model.name + " for run " + model.run + " on forecast " + str(forecast).zfill(2))
-            print("downloading")
-            forecast = str(forecast).zfill(2)
-            model.gribPaths = download.download_model(model.name, model.run, model.variables, forecast, current_time, sharedModel=model)
+        #one manifest for the whole run (extent, times, ranges and files of every forecast hour), written after each hour
+        runFolder = '\\\\192.168.0.54\\testing\\weather\\downloads\\' + model.name + '\\' + model.runEpoch + '\\'
+        model.manifest = convert.RunManifest(os.path.normpath(runFolder + "manifest.json"), model.name, model.runEpoch)
+
+        #forecast hours are downloaded concurrently and converted as soon as each one lands
+        print("downloading")
+        for forecast, gribPaths in download.downloadForecastHours(model.name, model.run, derived.requiredBands(model.derived, model.variables), range(model.forecastNb+1), current_time, sharedModel=model):
+            os.system("title Running " + model.name + " for run " + model.run + " on forecast " + forecast)
+            model.gribPaths = gribPaths
         
-            print("convert to PNG")
+            print("convert to " + convert.output_format.upper())
             model.pngFiles = []
+            #derived products are computed once per forecast hour, from all of its files
+            #(their inputs are in several files for the models published as one file per variable)
+            singleFile = (len(model.gribPaths) == 1)
             for file in model.gribPaths:
                 #in same folder as grib2 (but still get same name of grib2)
-                pngPath = '\\\\192.168.0.54\\testing\\weather\\downloads\\' + model.name + '\\' + model.runEpoch + '\\' + (".".join(file.split(".")[:-1]) + ".").split("/")[-1]
+                pngPath = runFolder + (".".join(file.split(".")[:-1]) + ".").split("/")[-1]
                 pngPath = os.path.normpath(pngPath)
                 print(pngPath)
-                model.pngFiles.append(convert.convertFromNCToPNG(file, pngPath, model.variables, vmin=vminDict,vmax=vmaxDict, model=model.name, sharedModel = model))
-            if (len(model.pngFiles) == 1):
-                model.pngFiles = model.pngFiles[0]
-
-            print("convert to WEBP")
-            for file in model.pngFiles:
-                #in same folder as png
-                webpFilename = ".".join(file.split(".")[:-1]) + ".webp"
-                model.webpFiles = convert.convertToWEBP(file, webpFilename)           
+                model.pngFiles.extend(renderedFilesList(convert.convertFromNCToPNG(file, pngPath, model.variables, vmin=vminDict,vmax=vmaxDict, model=model.name, sharedModel = model, webpSettings=webpSettingsDict, precision=precisionDict, jsonOutput=False, manifest=model.manifest, deltaVariables=deltaEncodedVariables, derivedVariables=model.derived if singleFile else None)))
+            if (not singleFile and len(model.derived) > 0):
+                derivedPath = os.path.normpath(runFolder + "total." + forecast + ".derived.")
+                model.pngFiles.extend(renderedFilesList(convert.convertFromNCToPNG(model.gribPaths[0], derivedPath, {}, vmin=vminDict,vmax=vmaxDict, model=model.name, sharedModel = model, webpSettings=webpSettingsDict, precision=precisionDict, jsonOutput=False, manifest=model.manifest, deltaVariables=deltaEncodedVariables, derivedVariables=model.derived, derivedFiles=model.gribPaths)))
+
+            #webp output is encoded directly by convertFromNCToPNG
+            if (convert.output_format == "png"):
+                print("convert to WEBP")
+                for file in model.pngFiles:
+                    #tile pyramids are already in webp
+                    if not (file.endswith(".png")):
+                        continue
+                    #in same folder as png
+                    webpFilename = ".".join(file.split(".")[:-1]) + ".webp"
+                    model.webpFiles = convert.convertToWEBP(file, webpFilename)           
+
+            #checkpoint of the run manifest once the hour is converted
+            model.manifest.flush()
+
+            #keep the download metrics up to date during the run to spot slow mirrors
+            download.writeMetrics()
+
+        model.manifest.flush()
+        print(f"{model.name} connection pool: {download.session.getStats()}")
+        print(f"{model.name} grib cache: {download.gribCache.getStats()}")
+        download.writeMetrics()
     except Exception as e:
         with open('log.txt', 'a') as f:
             f.write(str(e))
@@ -180,7 +258,7 @@ if __name__ == "__main__":
     with ThreadPoolExecutor() as executor:    
         while(1):
             for model in list_of_models:
-                isItTimeToDownload, timeOutput, current_time = download.isItTimeToDownload(model)
+                isItTimeToDownload, timeOutput, current_time = download.isRunAvailable(model)
             
                 if isItTimeToDownload:
                     with lock:
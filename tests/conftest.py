@@ -0,0 +1,111 @@
+import sys
+import os
+import types
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import secret
+except ImportError:
+    #secret.py holds the local credentials of the radar server and is not in the repository
+    sys.modules["secret"] = types.SimpleNamespace(username=None, password=None)
+
+class LocalHandler(BaseHTTPRequestHandler):
+    """
+    Routes of the local stand-in server:
+    /data/<size>: body of size bytes on a keep-alive connection
+    /stale: body, then the connection is closed without "Connection: close"
+    /short: Content-Length of 100 bytes but only 50 sent
+    /error/...: 503
+    /mirror/...: static grib2 file (Range requests) and its .idx
+    /listing/: directory listing with an ETag (304 if unchanged) and Range requests (206, 416)
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def sendBody(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if (self.command != "HEAD"):
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.client_address[1]))
+        if (self.path.startswith("/data/")):
+            self.sendBody(200, b"x" * int(self.path.split("/")[-1]))
+        elif (self.path == "/stale"):
+            self.sendBody(200, b"stale")
+            self.close_connection = True
+        elif (self.path == "/short"):
+            self.send_response(200)
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            self.wfile.write(b"x" * 50)
+            self.close_connection = True
+        elif (self.path.startswith("/error/")):
+            self.sendBody(503, b"unavailable")
+        elif (self.path.startswith("/mirror/")):
+            grib = self.server.grib
+            if (self.path.endswith(".idx")):
+                self.sendBody(200, self.server.idx.encode())
+            elif (self.headers.get("Range")):
+                start, end = self.headers["Range"].split("=")[1].split("-")
+                end = int(end) if end else len(grib) - 1
+                self.sendBody(206, grib[int(start):end + 1], {"Content-Range": f"bytes {start}-{end}/{len(grib)}"})
+            else:
+                self.sendBody(200, grib)
+        elif (self.path.startswith("/listing/")):
+            listing = self.server.listing
+            headers = {"ETag": '"' + hashlib.sha1(listing).hexdigest() + '"', "Accept-Ranges": "bytes"}
+            if (self.headers.get("If-None-Match") == headers["ETag"]):
+                self.server.listingAnswers.append(304)
+                self.send_response(304)
+                self.send_header("ETag", headers["ETag"])
+                self.end_headers()
+            elif (self.headers.get("Range")):
+                start = int(self.headers["Range"].split("=")[1].split("-")[0])
+                if (start >= len(listing)):
+                    self.server.listingAnswers.append(416)
+                    self.sendBody(416, b"", {"Content-Range": f"bytes */{len(listing)}"})
+                else:
+                    self.server.listingAnswers.append(206)
+                    headers["Content-Range"] = f"bytes {start}-{len(listing) - 1}/{len(listing)}"
+                    self.sendBody(206, listing[start:], headers)
+            else:
+                self.server.listingAnswers.append(200)
+                self.sendBody(200, listing, headers)
+        else:
+            self.sendBody(404, b"not found")
+
+@pytest.fixture
+def localServer():
+    """
+    Local http server (see LocalHandler), yields its base url. server.requests lists the
+    (path, client port) of every request.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LocalHandler)
+    server.daemon_threads = True
+    server.requests = []
+    #two grib messages: REFC (bytes 0-9) and TMP at 2 m (bytes 10-19)
+    server.grib = b"REFCREFCRE" + b"TMPTMPTMPT"
+    server.idx = "1:0:d=2025012300:REFC:entire atmosphere:1 hour fcst:\n2:10:d=2025012300:TMP:2 m above ground:1 hour fcst:\n"
+    #set by the tests, listingAnswers lists the status answered to each request of the listing
+    server.listing = b""
+    server.listingAnswers = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,41 @@
+from datetime import datetime, timezone
+import download
+
+def fixedNow(monkeypatch, now):
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+    monkeypatch.setattr(download, "datetime", FixedDatetime)
+
+def resetAvailability(monkeypatch, tmp_path, history):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(download, "_publicationLatencies", {"HRRR": list(history)})
+    monkeypatch.setattr(download, "_detectedRuns", {})
+    monkeypatch.setattr(download, "_missedRuns", set())
+    monkeypatch.setattr(download, "isForecastAvailable", lambda *args: True)
+
+def test_expected_latency_follows_recent_runs(monkeypatch, tmp_path):
+    #a quick run out of the window doesn't keep the probing early forever
+    resetAvailability(monkeypatch, tmp_path, [30] + [90] * download.publicationLatencyWindow)
+    assert download.expectedPublicationLatency("HRRR") == 90
+
+def test_quicker_run_found_on_first_probe_lowers_latency(monkeypatch, tmp_path):
+    resetAvailability(monkeypatch, tmp_path, [60] * 5)
+    #probing of the 12z run starts at 12:55, it is already published at 12:57
+    fixedNow(monkeypatch, datetime(2025, 1, 23, 12, 57, tzinfo=timezone.utc))
+
+    available, hour, date = download.isRunAvailable("HRRR")
+
+    assert available and hour == 12
+    assert download.expectedPublicationLatency("HRRR") == 57
+
+def test_slower_run_found_on_first_probe_not_learned(monkeypatch, tmp_path):
+    resetAvailability(monkeypatch, tmp_path, [60] * 5)
+    #found at 13:30, 90 minutes only bounds the latency of the 12z run
+    fixedNow(monkeypatch, datetime(2025, 1, 23, 13, 30, tzinfo=timezone.utc))
+
+    available, hour, date = download.isRunAvailable("HRRR")
+
+    assert available and hour == 12
+    assert download.loadPublicationLatencies()["HRRR"] == [60] * 5
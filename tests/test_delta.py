@@ -0,0 +1,68 @@
+import io
+import json
+import os
+import pytest
+import numpy as np
+
+#the conversion needs GDAL, Py-ART and Wand
+for module in ("osgeo", "pyart", "wand", "PIL"):
+    pytest.importorskip(module)
+
+import PIL.Image
+import convert
+
+def decodeDelta(zigzag, reference, bits):
+    mask = 2 ** bits - 1
+    signed = (zigzag.astype(np.int64) >> 1) ^ -(zigzag.astype(np.int64) & 1)
+    return (reference + signed) & mask
+
+def webpCodes(data, bits):
+    return convert.rgbToCodes(np.asarray(PIL.Image.open(io.BytesIO(data)).convert("RGB")), bits)
+
+@pytest.mark.parametrize("bits", [8, 16, 24])
+def test_delta_roundtrip(bits, monkeypatch):
+    monkeypatch.setattr(convert, "deltaHistory", {})
+    monkeypatch.setattr(convert, "delta_keyframe_interval", 3)
+    mask = 2 ** bits - 1
+    random = np.random.default_rng(bits)
+    frames = [random.integers(0, mask + 1, (16, 16), dtype=np.int64)]
+    for hour in range(4):
+        #small changes, some crossing 0 or 2^bits - 1 (wrapped around), and an unchanged area
+        change = random.integers(-3, 4, (16, 16))
+        change[:8] = 0
+        frames.append((frames[-1] + change) & mask)
+    frames[2][15, 8:] = [0, mask] * 4
+    frames[3][15, 8:] = [mask, 0] * 4
+
+    encodings = []
+    decoded = {}
+    for hour, codes in enumerate(frames):
+        rgb_array = convert.codesToRGB(codes.astype(np.uint32), bits)
+        encoding = convert.deltaEncode(("run", "TMP", "lev_2_m_above_ground"), hour * 3600, rgb_array, bits)
+        encodings.append(encoding["encoding"])
+        stored = webpCodes(convert.encodeWEBP(rgb_array, None, exact=True), bits)
+        if (encoding["encoding"] == "delta"):
+            assert np.all(stored[:8] == 0)
+            stored = decodeDelta(stored, decoded[encoding["reference"]], bits)
+        decoded[hour * 3600] = stored
+        assert np.array_equal(stored, codes)
+    assert encodings == ["keyframe", "delta", "delta", "keyframe", "delta"]
+
+def test_unchanged_tiles_kept_in_delta_frames(tmp_path, monkeypatch):
+    monkeypatch.setattr(convert, "tile_size", 4)
+    monkeypatch.setattr(convert, "tile_zoom_levels", 1)
+    rgb_array = np.zeros((4, 8, 3), dtype=np.uint8)
+    rgb_array[:, 4:] = 7
+
+    #keyframe: the tile of nodata pixels is skipped
+    manifest = convert.exportTiles(str(tmp_path / "key.webp"), rgb_array, [0, 0, 8, 4], 0)
+    with open(manifest) as f:
+        assert json.load(f)["levels"][0]["tiles"] == [[1, 0]]
+
+    #delta frame: zero codes are unchanged pixels, the tile is written opaque
+    manifest = convert.exportTiles(str(tmp_path / "delta.webp"), rgb_array, [0, 0, 8, 4], 0, {"exact": True, "opaque": True})
+    with open(manifest) as f:
+        assert json.load(f)["levels"][0]["tiles"] == [[0, 0], [1, 0]]
+    image = PIL.Image.open(os.path.join(convert.tilesPath(str(tmp_path / "delta.webp")), "0", "0", "0.webp"))
+    assert image.mode == "RGB"
+    assert not np.any(np.asarray(image))
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import derived
+
+requested = {"WIND": ["lev_10_m_above_ground"],
+             "SHEAR": ["lev_0-6000_m_above_ground"],
+             "CAPESHEAR": ["lev_surface"]}
+
+def test_plan_orders_shared_inputs():
+    plan = derived.derivedPlan(requested)
+
+    assert plan["order"] == [("WIND", "lev_10_m_above_ground"), ("SHEAR", "lev_0-6000_m_above_ground"), ("CAPESHEAR", "lev_surface")]
+    assert plan["bands"] == {"UGRD": ["lev_10_m_above_ground"], "VGRD": ["lev_10_m_above_ground"],
+                             "VUCSH": ["lev_0-6000_m_above_ground"], "VVCSH": ["lev_0-6000_m_above_ground"],
+                             "CAPE": ["lev_surface"]}
+    #SHEAR is requested and is an input of CAPESHEAR
+    assert plan["uses"][("SHEAR", "lev_0-6000_m_above_ground")] == 2
+    assert derived.requiredBands(requested, {"CAPE": ["lev_surface"], "TMP": ["lev_2_m_above_ground"]})["CAPE"] == ["lev_surface"]
+
+def test_plan_rejects_cycles(monkeypatch):
+    monkeypatch.setitem(derived.derivedProducts, "A", {"inputs": [("B", None)], "function": np.negative})
+    monkeypatch.setitem(derived.derivedProducts, "B", {"inputs": [("A", None)], "function": np.negative})
+    with pytest.raises(Exception, match="depend on each other"):
+        derived.derivedPlan({"A": ["lev_surface"]})
+
+def test_inputs_loaded_once_and_released():
+    bands = {("UGRD", "lev_10_m_above_ground"): 3.0, ("VGRD", "lev_10_m_above_ground"): 4.0,
+             ("VUCSH", "lev_0-6000_m_above_ground"): 6.0, ("VVCSH", "lev_0-6000_m_above_ground"): 8.0}
+    loads = []
+    def loadBand(variable, level):
+        loads.append((variable, level))
+        return np.full((2, 2), bands[(variable, level)]) if ((variable, level) in bands) else None
+    fields = derived.DerivedFields(requested, loadBand)
+    #CAPE read for its own conversion is handed over instead of read again
+    assert fields.needs("CAPE", "lev_surface")
+    fields.offer("CAPE", "lev_surface", np.full((2, 2), -100.0))
+    fields.offer("TMP", "lev_2_m_above_ground", np.zeros((2, 2)))
+
+    assert np.all(fields.get("CAPESHEAR", "lev_surface") == 0)
+    #SHEAR computed for CAPESHEAR is kept until it is taken
+    assert ("SHEAR", "lev_0-6000_m_above_ground") in fields.cache
+    assert np.all(fields.get("SHEAR", "lev_0-6000_m_above_ground") == 10)
+    assert fields.get("WIND", "lev_10_m_above_ground").dtype == np.float32
+
+    assert sorted(loads) == sorted(bands)
+    assert fields.cache == {}
+
+def test_missing_input_gives_none():
+    fields = derived.DerivedFields({"DEPR": ["lev_2_m_above_ground"]},
+                                   lambda variable, level: np.zeros((2, 2)) if (variable == "TMP") else None)
+    assert fields.get("DEPR", "lev_2_m_above_ground") is None
+    assert fields.cache == {}
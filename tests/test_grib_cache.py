@@ -0,0 +1,57 @@
+import os
+import time
+import download
+
+variables = {"TMP": ["lev_2_m_above_ground"]}
+
+def storeHour(cache, tmp_path, forecastTime, content):
+    path = str(tmp_path / f"downloaded.{forecastTime}.grib2")
+    with open(path, "wb") as f:
+        f.write(content)
+    cache.store("HRRR", "20250123", "00", forecastTime, variables, [path])
+    #entries stored in the same clock tick would have the same lastAccess
+    time.sleep(0.01)
+
+def test_store_and_fetch(tmp_path):
+    cache = download.GribCache(str(tmp_path / "cache"), 1000)
+    storeHour(cache, tmp_path, 1, b"TMPTMPTMPT")
+
+    #the index is saved, a new cache on the folder serves the entry
+    cache = download.GribCache(str(tmp_path / "cache"), 1000)
+    paths = cache.fetch("HRRR", "20250123", "00", 1, variables, str(tmp_path / "downloads") + "/total.01.")
+
+    assert paths == [str(tmp_path / "downloads" / "downloaded.1.grib2")]
+    with open(paths[0], "rb") as f:
+        assert f.read() == b"TMPTMPTMPT"
+    assert cache.fetch("HRRR", "20250123", "00", 2, variables, str(tmp_path / "downloads") + "/total.02.") == None
+    assert cache.getStats()["hits"] == 1
+    assert cache.getStats()["misses"] == 1
+
+def test_corrupted_entry_dropped(tmp_path):
+    cache = download.GribCache(str(tmp_path / "cache"), 1000)
+    storeHour(cache, tmp_path, 1, b"TMPTMPTMPT")
+    key = cache.key("HRRR", "20250123", "00", 1, variables)
+    cachedPath = str(tmp_path / "cache" / key / "downloaded.1.grib2")
+    #same size, other content: only the sha256 catches it
+    os.remove(cachedPath)
+    with open(cachedPath, "wb") as f:
+        f.write(b"REFCREFCRE")
+
+    assert cache.fetch("HRRR", "20250123", "00", 1, variables, str(tmp_path / "downloads") + "/total.01.") == None
+    assert cache.getStats()["corrupted"] == 1
+    assert not os.path.exists(str(tmp_path / "cache" / key))
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = download.GribCache(str(tmp_path / "cache"), 25)
+    storeHour(cache, tmp_path, 1, b"x" * 10)
+    storeHour(cache, tmp_path, 2, b"x" * 10)
+    assert cache.fetch("HRRR", "20250123", "00", 1, variables, str(tmp_path / "downloads") + "/total.01.") != None
+    time.sleep(0.01)
+    #over maxSize, forecast hour 2 is the least recently used
+    storeHour(cache, tmp_path, 3, b"x" * 10)
+
+    assert cache.getStats()["evictions"] == 1
+    assert cache.fetch("HRRR", "20250123", "00", 2, variables, str(tmp_path / "downloads") + "/total.02.") == None
+    for forecastTime in (1, 3):
+        assert cache.fetch("HRRR", "20250123", "00", forecastTime, variables, str(tmp_path / "downloads") + "/total.0" + str(forecastTime) + ".") != None
+    assert not any(name.endswith(".part") for name in os.listdir(str(tmp_path / "cache")))
@@ -0,0 +1,36 @@
+import os
+import time
+import pytest
+import download
+
+def test_connection_reused(localServer):
+    session = download.HTTPSession(timeout=5)
+    for i in range(3):
+        with session.request(localServer.url + "/data/1000") as response:
+            assert response.read() == b"x" * 1000
+
+    assert session.getStats()["connectionsCreated"] == 1
+    assert session.getStats()["connectionsReused"] == 2
+    #the three requests came through the same socket
+    assert len({port for path, port in localServer.requests}) == 1
+
+def test_stale_connection_retried(localServer):
+    session = download.HTTPSession(timeout=5)
+    with session.request(localServer.url + "/stale") as response:
+        assert response.read() == b"stale"
+    #the server closed the pooled connection after answering
+    time.sleep(0.2)
+    with session.request(localServer.url + "/data/10") as response:
+        assert response.read() == b"x" * 10
+
+    #the pooled connection was tried first, then the request was sent again on a new one
+    assert session.getStats()["connectionsReused"] == 1
+    assert session.getStats()["connectionsCreated"] == 2
+    assert len({port for path, port in localServer.requests}) == 2
+
+def test_short_body_removes_part_file(localServer, tmp_path):
+    filepath = str(tmp_path) + "/total.01."
+    with pytest.raises(Exception, match="truncated"):
+        download.downloadOnce(localServer.url + "/short", filepath)
+
+    assert os.listdir(tmp_path) == []
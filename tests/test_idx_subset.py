@@ -0,0 +1,33 @@
+import download
+
+idx = """1:0:d=2025012300:REFC:entire atmosphere:1 hour fcst:
+2:100:d=2025012300:UGRD:10 m above ground:1 hour fcst:
+2.1:100:d=2025012300:VGRD:10 m above ground:1 hour fcst:
+3:250:d=2025012300:TMP:2 m above ground:1 hour fcst:
+4:400:d=2025012300:TMP:500 mb:1 hour fcst:
+5:600:d=2025012300:DPT:2 m above ground:1 hour fcst:
+"""
+
+def test_select_byte_ranges():
+    inventory = download.parseIdx(idx)
+    assert [message["end"] for message in inventory] == [99, 249, 249, 399, 599, None]
+
+    #submessages share their range, adjacent messages are merged in one request
+    ranges = download.selectIdxByteRanges(inventory, {"UGRD": ["lev_10_m_above_ground"], "VGRD": ["lev_10_m_above_ground"],
+                                                      "TMP": ["lev_2_m_above_ground"]})
+    assert ranges == [(100, 399)]
+    #the last message goes to the end of the file
+    assert download.selectIdxByteRanges(inventory, {"REFC": ["all_lev"], "DPT": ["lev_2_m_above_ground"]}) == [(0, 99), (600, None)]
+    assert download.selectIdxByteRanges(inventory, {"CAPE": ["lev_surface"]}) == []
+
+def test_subset_download(localServer, tmp_path):
+    link = localServer.url + "/mirror/hrrr.20250123/hrrr.t00z.wrfsfcf01.grib2"
+
+    paths = download.downloadIdxSubsetOnce(link, str(tmp_path) + "/total.01.", {"TMP": ["lev_2_m_above_ground"]})
+
+    assert paths == [str(tmp_path) + "/total.01.hrrr.t00z.wrfsfcf01.grib2"]
+    with open(paths[0], "rb") as f:
+        assert f.read() == b"TMPTMPTMPT"
+    #the inventory, then only the TMP message
+    assert [path for path, port in localServer.requests] == ["/mirror/hrrr.20250123/hrrr.t00z.wrfsfcf01.grib2.idx",
+                                                             "/mirror/hrrr.20250123/hrrr.t00z.wrfsfcf01.grib2"]
@@ -0,0 +1,55 @@
+import download
+
+def listing(files):
+    return b"<html><body>\n" + b"".join(f'<a href="{file}">{file}</a>\n'.encode() for file in files) + b"</body></html>\n"
+
+def setupListing(localServer, monkeypatch, files):
+    monkeypatch.setattr(download, "_listingCache", {})
+    monkeypatch.setattr(download, "listingTailOverlap", 100)
+    localServer.listing = listing(files)
+    return localServer.url + "/listing/"
+
+def test_unchanged_listing_not_modified(localServer, monkeypatch):
+    files = [f"2025012300{i:02}_CASET_V06.gz" for i in range(10)]
+    url = setupListing(localServer, monkeypatch, files)
+
+    assert download.listRemoteFilesConditional(url) == files
+    assert download.listRemoteFilesConditional(url) == files
+    assert localServer.listingAnswers == [200, 304]
+
+def test_new_files_fetched_from_tail(localServer, monkeypatch):
+    files = [f"2025012300{i:02}_CASET_V06.gz" for i in range(10)]
+    url = setupListing(localServer, monkeypatch, files)
+    download.listRemoteFilesConditional(url)
+    fullLength = len(localServer.listing)
+
+    files.append("202501230010_CASET_V06.gz")
+    localServer.listing = listing(files)
+
+    assert download.listRemoteFilesConditional(url) == files
+    assert localServer.listingAnswers == [200, 206]
+    #the next tail starts from the end of the new listing
+    assert download._listingCache[url]["length"] == len(localServer.listing) > fullLength
+
+def test_shorter_listing_fetched_again(localServer, monkeypatch):
+    files = [f"2025012300{i:02}_CASET_V06.gz" for i in range(10)]
+    url = setupListing(localServer, monkeypatch, files)
+    download.listRemoteFilesConditional(url)
+
+    #the files of the previous day were removed: the tail starts past the end of the listing
+    localServer.listing = listing(files[8:])
+
+    assert download.listRemoteFilesConditional(url) == files[8:]
+    assert localServer.listingAnswers == [200, 416, 200]
+
+def test_tail_without_known_files_fetched_again(localServer, monkeypatch):
+    files = [f"2025012300{i:02}_CASET_V06.gz" for i in range(10)]
+    url = setupListing(localServer, monkeypatch, files)
+    download.listRemoteFilesConditional(url)
+
+    #as long as before, but none of the files of the tail were listed
+    files = [f"2025012301{i:02}_CASET_V06.gz" for i in range(10)]
+    localServer.listing = listing(files)
+
+    assert download.listRemoteFilesConditional(url) == files
+    assert localServer.listingAnswers == [200, 206, 200]
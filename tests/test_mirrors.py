@@ -0,0 +1,25 @@
+import download
+
+def test_failover_to_next_mirror(localServer, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(download.modelMirrors, "HRRR", ["AWS", "GCP"])
+    monkeypatch.setitem(download.staticUrlTemplates["AWS"], "HRRR", localServer.url + "/error/hrrr.{date}/hrrr.t{run}z.wrfsfcf{forecast2}.grib2")
+    monkeypatch.setitem(download.staticUrlTemplates["GCP"], "HRRR", localServer.url + "/mirror/hrrr.{date}/hrrr.t{run}z.wrfsfcf{forecast2}.grib2")
+    monkeypatch.setattr(download, "mirrorStats", download.MirrorStats())
+    monkeypatch.setattr(download, "useGribCache", False)
+
+    hours = list(download.downloadForecastHours("HRRR", "00", {"TMP": ["lev_2_m_above_ground"]}, [1],
+                                                current_time="20250123", waitForAvailability=False))
+
+    forecastTime, filepaths = hours[0]
+    assert forecastTime == "01"
+    with open(filepaths[0], "rb") as f:
+        assert f.read() == b"TMPTMPTMPT"
+    #the first mirror answered 503 and the download went to the second one
+    assert any(path.startswith("/error/") for path, port in localServer.requests)
+    stats = download.mirrorStats.getStats()
+    assert stats["AWS"]["failures"] == 1
+    assert stats["AWS"]["successes"] == 0
+    assert download.mirrorStats.isCoolingDown("AWS")
+    assert stats["GCP"]["successes"] == 1
+    assert download.selectMirror("HRRR") == "GCP"
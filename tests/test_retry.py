@@ -0,0 +1,43 @@
+import threading
+import pytest
+import download
+
+def test_backoff_delay_capped_with_jitter():
+    policy = {"baseDelay": 5, "maxDelay": 120}
+    for attempt in range(10):
+        delay = min(120, 5 * 2 ** attempt)
+        assert delay / 2 <= download.backoffDelay(attempt, policy) <= delay
+
+def test_scheduler_calls_in_delay_order():
+    scheduler = download.RetryScheduler()
+    calls = []
+    done = threading.Event()
+    scheduler.schedule(0.2, lambda: (calls.append("late"), done.set()))
+    scheduler.schedule(0.05, calls.append, "early")
+    #schedule returns right away, nothing is due yet
+    assert scheduler.pending() == 2
+
+    assert done.wait(5)
+    assert calls == ["early", "late"]
+    assert scheduler.pending() == 0
+
+def failingRun(localServer, tmp_path, monkeypatch, policy):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(download.modelMirrors, "HRRR", ["AWS"])
+    monkeypatch.setitem(download.staticUrlTemplates["AWS"], "HRRR", localServer.url + "/error/hrrr.{date}/hrrr.t{run}z.wrfsfcf{forecast2}.grib2")
+    monkeypatch.setitem(download.modelRetryPolicies, "HRRR", policy)
+    monkeypatch.setattr(download, "mirrorStats", download.MirrorStats())
+    monkeypatch.setattr(download, "useGribCache", False)
+    with pytest.raises(download.HTTPStatusError):
+        list(download.downloadForecastHours("HRRR", "00", {"TMP": ["lev_2_m_above_ground"]}, [1],
+                                            current_time="20250123", waitForAvailability=False))
+    return [path for path, port in localServer.requests if path.startswith("/error/")]
+
+def test_retries_backoff_on_single_mirror(localServer, tmp_path, monkeypatch):
+    #no other mirror to fail over to, the download is retried after the backoff until maxRetries
+    requests = failingRun(localServer, tmp_path, monkeypatch, {"maxRetries": 3, "baseDelay": 0.01, "maxDelay": 0.05})
+    assert len(requests) == 3
+
+def test_gives_up_on_status(localServer, tmp_path, monkeypatch):
+    requests = failingRun(localServer, tmp_path, monkeypatch, {"maxRetries": 3, "giveUpOnStatus": [503]})
+    assert len(requests) == 1
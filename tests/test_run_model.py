@@ -0,0 +1,41 @@
+import os
+import pytest
+
+#the conversion needs GDAL, Py-ART and Wand
+for module in ("osgeo", "pyart", "wand", "PIL"):
+    pytest.importorskip(module)
+
+import convert
+import download
+import run_model
+
+def test_png_path_with_derived_products(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    #HRDPS: one file per variable, WIND and DEPR computed from all the files of the hour
+    gribPaths = [f"./downloads/HRDPS/00/total.01.20250123T00Z_MSC_HRDPS_{variable}_RLatLon0.0225_PT001H.grib2"
+                 for variable in ("TMP_AGL-2m", "DPT_AGL-2m", "UGRD_AGL-10m", "VGRD_AGL-10m")]
+    monkeypatch.setattr(download, "downloadForecastHours", lambda *args, **kwargs: iter([("01", gribPaths)]))
+    monkeypatch.setattr(download, "writeMetrics", lambda *args: None)
+
+    calls = []
+    def convertFromNCToPNG(file, exportPath, variables, **kwargs):
+        calls.append(kwargs)
+        if (kwargs.get("derivedFiles") != None):
+            return [exportPath + "WIND.AGL-10m.png", exportPath + "DEPR.AGL-2m.png"]
+        return exportPath + file.split("_")[3] + ".AGL-2m.png"
+    converted = []
+    monkeypatch.setattr(convert, "convertFromNCToPNG", convertFromNCToPNG)
+    monkeypatch.setattr(convert, "convertToWEBP", lambda file, webpFilename: converted.append(webpFilename))
+    monkeypatch.setattr(convert, "output_format", "png")
+    monkeypatch.setitem(run_model.derivedHRDPS, "WIND", ["AGL-10m"])
+    monkeypatch.setitem(run_model.derivedHRDPS, "DEPR", ["AGL-2m"])
+
+    run_model.processModel("HRDPS", 0, "20250123")
+
+    #processModel writes its errors to log.txt instead of raising them
+    assert not os.path.exists("log.txt")
+    #the derived products are computed in one call with every file of the hour
+    assert [call.get("derivedFiles") for call in calls] == [None] * 4 + [gribPaths]
+    assert len(converted) == 6
+    assert sum(file.endswith("derived.WIND.AGL-10m.webp") for file in converted) == 1
+    assert sum(file.endswith("derived.DEPR.AGL-2m.webp") for file in converted) == 1